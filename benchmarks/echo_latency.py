@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import threading
+import asyncio
+
+# Modules are imported from src, configured by the config file passed as an argument
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import network
+import transport
+
+# Measures round trip times of many concurrent flows between pairs of sockets on this node,
+# each a client sending to a server which echoes back.
+# Uses a thread per socket with the "threads" runtime,
+# and coroutines on the event loop with the "asyncio" runtime (network.runtime in the config).
+#
+# Logging should be disabled. Lost packets aren't retransmitted, so flows should be
+# few enough that a packet from each fits in the link's socket receive buffer.
+#
+# Usage: python3 benchmarks/echo_latency.py <config file> [flows] [rounds]
+
+flows = 50 if len(sys.argv) < 3 else int(sys.argv[2])
+rounds = 200 if len(sys.argv) < 4 else int(sys.argv[3])
+
+BASE_PORT = 2000
+# Packets to ourselves
+ilv = "%s:%s" % (network.locs_joined[0], network.local_nid)
+
+round_trip_times = []
+
+
+def bind(port, receive_block):
+    sock = transport.Socket()
+    sock.bind(port)
+    if receive_block:
+        sock.set_receive_block(True)
+    return sock
+
+
+def run_threads():
+    def serve(sock):
+        for _ in range(rounds):
+            data, src_addrinfo, dst_addrinfo, interface = sock.receive()
+            sock.send(src_addrinfo, bytes(data))
+
+    def client(sock, server_port):
+        for i in range(rounds):
+            start = time.perf_counter()
+            sock.send((ilv, server_port), i.to_bytes(8, "big"))
+            sock.receive()
+            round_trip_times.append(time.perf_counter() - start)
+
+    threads = []
+    for flow in range(flows):
+        server_port = BASE_PORT + 2 * flow
+        threads.append(threading.Thread(target=serve, args=(bind(server_port, True),)))
+        threads.append(threading.Thread(target=client, args=(bind(server_port + 1, True), server_port)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+async def run_asyncio():
+    async def serve(sock):
+        for _ in range(rounds):
+            data, src_addrinfo, dst_addrinfo, interface = await sock.async_receive()
+            await sock.async_send(src_addrinfo, bytes(data))
+
+    async def client(sock, server_port):
+        for i in range(rounds):
+            start = time.perf_counter()
+            await sock.async_send((ilv, server_port), i.to_bytes(8, "big"))
+            await sock.async_receive()
+            round_trip_times.append(time.perf_counter() - start)
+
+    tasks = []
+    for flow in range(flows):
+        server_port = BASE_PORT + 2 * flow
+        tasks.append(serve(bind(server_port, False)))
+        tasks.append(client(bind(server_port + 1, False), server_port))
+    await asyncio.gather(*tasks)
+
+
+start = time.perf_counter()
+if network.runtime == "asyncio":
+    transport.run(run_asyncio())
+else:
+    run_threads()
+elapsed = time.perf_counter() - start
+
+round_trip_times.sort()
+def percentile(p):
+    return round_trip_times[min(len(round_trip_times) - 1, int(len(round_trip_times) * p))] * 1000
+
+print("%s: %d flows, %d round trips/s" % (network.runtime, flows, len(round_trip_times) / elapsed))
+print("round trip ms: p50 %.3f  p99 %.3f  max %.3f" % (percentile(0.5), percentile(0.99), percentile(1)))
+os._exit(0)
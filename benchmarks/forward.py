@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+
+# Modules are imported from src, configured by the config file passed as an argument
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import network
+import codec
+
+# Measures packets per second through the network layer's handling of a packet
+# received on one locator that is to be forwarded to another,
+# as a router joined to both locators would.
+#
+# The config's network.locators should be two locators, e.g. 0:0:0:a,0:0:0:b,
+# and logging should be disabled.
+#
+# Usage: python3 benchmarks/forward.py <config file> [packets]
+
+packets = 100000 if len(sys.argv) < 3 else int(sys.argv[2])
+
+in_loc, out_loc = network.locs_joined[:2]
+# Make the destination reachable via out_loc
+dst_loc = "0:0:0:fe"
+network.loc_to_interface.add_static(codec.hex_to_bytes(dst_loc), out_loc)
+
+header = codec.pack(
+    network.STATIC_MASKS_FIELD, 1400, 42, 255,
+    codec.hex_to_bytes(in_loc),
+    codec.hex_to_bytes("ffff:0:0:fe"),
+    codec.hex_to_bytes(dst_loc),
+    codec.hex_to_bytes("ffff:0:0:ff"),
+)
+packet = header + bytes(1400)
+# Received from another node
+from_addr = "benchmark"
+
+start = time.perf_counter()
+for i in range(packets):
+    message = memoryview(bytearray(packet))
+    network._receive(message, in_loc, from_addr)
+elapsed = time.perf_counter() - start
+print("forward %10.0f pps" % (packets / elapsed))
+os._exit(0)
@@ -0,0 +1,114 @@
+import os
+import sys
+import struct
+import timeit
+
+# Modules are imported from src, configured by the config file passed as an argument
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import codec
+import util
+
+# Compares encoding and decoding an ILNPv6 header with codec
+# against the previous per field conversions through hex strings.
+#
+# Usage: python3 benchmarks/header_codec.py <config file> [iterations]
+
+iterations = 200000 if len(sys.argv) < 3 else int(sys.argv[2])
+
+LOC       = "0:0:0:a"
+NID       = "ffff:0:0:a"
+REMOTE_LOC = "0:0:0:b"
+REMOTE_NID = "ffff:0:0:b"
+
+LOCAL_NID_BYTES = codec.hex_to_bytes(NID)
+
+
+def encode_strings():
+    return struct.pack("!4s2sss8s8s8s8s",
+        (0).to_bytes(4, byteorder="big", signed=False),
+        util.int_to_bytes(1400, 2),
+        util.int_to_bytes(42,   1),
+        util.int_to_bytes(3,    1),
+        util.hex_to_bytes(LOC,        8),
+        util.hex_to_bytes(NID,        8),
+        util.hex_to_bytes(REMOTE_LOC, 8),
+        util.hex_to_bytes(REMOTE_NID, 8),
+    )
+
+
+def encode_codec():
+    return codec.pack(
+        0, 1400, 42, 3,
+        codec.hex_to_bytes(LOC),
+        LOCAL_NID_BYTES,
+        codec.hex_to_bytes(REMOTE_LOC),
+        codec.hex_to_bytes(REMOTE_NID),
+    )
+
+
+HEADER = encode_codec()
+assert HEADER == encode_strings()
+PACKET = memoryview(bytearray(HEADER + bytes(1400)))
+
+
+def decode_strings():
+    (
+        masked_bytes,
+        payload_length_bytes,
+        next_header_bytes,
+        hop_limit_bytes,
+        src_loc_bytes,
+        src_nid_bytes,
+        dst_loc_bytes,
+        dst_nid_bytes,
+    ) = struct.unpack("!4s2sss8s8s8s8s", PACKET[:40])
+    return (
+        util.bytes_to_int(payload_length_bytes),
+        util.bytes_to_int(next_header_bytes),
+        util.bytes_to_int(hop_limit_bytes),
+        util.bytes_to_hex(src_loc_bytes),
+        util.bytes_to_hex(src_nid_bytes),
+        util.bytes_to_hex(dst_loc_bytes),
+        util.bytes_to_hex(dst_nid_bytes),
+    )
+
+
+def decode_codec():
+    (
+        masked_fields,
+        payload_length,
+        next_header,
+        hop_limit,
+        src_loc_bytes,
+        src_nid_bytes,
+        dst_loc_bytes,
+        dst_nid_bytes,
+    ) = codec.unpack(PACKET)
+    return (
+        payload_length,
+        next_header,
+        hop_limit,
+        codec.bytes_to_hex(src_loc_bytes),
+        codec.bytes_to_hex(src_nid_bytes),
+        codec.bytes_to_hex(dst_loc_bytes),
+        codec.bytes_to_hex(dst_nid_bytes),
+    )
+
+
+# Only the fields needed to forward a packet
+def decode_codec_lazy():
+    return codec.dst_loc(PACKET), codec.dst_nid(PACKET), codec.hop_limit(PACKET)
+
+
+assert decode_codec() == decode_strings()
+
+for name, function in [
+    ("encode strings",     encode_strings),
+    ("encode codec",       encode_codec),
+    ("decode strings",     decode_strings),
+    ("decode codec",       decode_codec),
+    ("decode codec lazy",  decode_codec_lazy),
+]:
+    seconds = min(timeit.repeat(function, number=iterations, repeat=3))
+    print("%-20s %8.0f ns/op" % (name, seconds / iterations * 1e9))
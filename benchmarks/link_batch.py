@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+
+# Modules are imported from src, configured by the config file passed as an argument
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import link
+
+# Compares packets per second of the one-at-a-time link send and receive loops
+# against their batched equivalents, over multicast loopback on one locator.
+# Batching still makes a syscall per packet, so expect little difference here;
+# what it saves is in the network layer, measured by receive_batch.py.
+#
+# Usage: python3 benchmarks/link_batch.py <config file> [rounds]
+
+LOC = "0:0:0:fe"
+FRAME = bytes(64)
+# Frames sent before draining the socket, small enough to fit in the socket receive buffer
+FRAMES_PER_ROUND = 100
+
+rounds = 200 if len(sys.argv) < 3 else int(sys.argv[2])
+
+# Don't measure logging
+link.log_file = None
+link.join(LOC)
+# Frames are received on the locator's own socket if the link has a socket per locator
+receive_interface = LOC if link.sharded else None
+
+
+def bench_send(send_round):
+    elapsed = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        send_round()
+        elapsed += time.perf_counter() - start
+        # Empty the socket receive buffer of looped back frames
+        drain()
+    return FRAMES_PER_ROUND * rounds / elapsed
+
+
+def bench_receive(receive_round):
+    elapsed = 0
+    for _ in range(rounds):
+        link.send_batch([(LOC, FRAME)] * FRAMES_PER_ROUND)
+        # Wait for the frames to be looped back
+        time.sleep(0.001)
+        start = time.perf_counter()
+        receive_round()
+        elapsed += time.perf_counter() - start
+    return FRAMES_PER_ROUND * rounds / elapsed
+
+
+def drain():
+    link.batch_size = FRAMES_PER_ROUND
+    received = 0
+    while received < FRAMES_PER_ROUND:
+        received += len(link.receive_batch(receive_interface))
+
+
+def send_single():
+    for _ in range(FRAMES_PER_ROUND):
+        link.send(LOC, FRAME)
+
+
+def send_batched():
+    link.send_batch([(LOC, FRAME)] * FRAMES_PER_ROUND)
+
+
+def receive_single():
+    for _ in range(FRAMES_PER_ROUND):
+        link.receive(receive_interface)
+
+
+def receive_batched():
+    drain()
+
+
+results = [
+    ("send",          bench_send(send_single)),
+    ("send_batch",    bench_send(send_batched)),
+    ("receive",       bench_receive(receive_single)),
+    ("receive_batch", bench_receive(receive_batched)),
+]
+for name, pps in results:
+    print("%-15s %10.0f pps" % (name, pps))
+
+link.leave(LOC)
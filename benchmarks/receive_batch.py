@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import threading
+
+# Modules are imported from src, configured by the config file passed as an argument
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import network
+import codec
+
+# Measures what link.batch_size saves in the network layer: packets per second
+# from handling received packets to a thread waiting for them on receive_cvs,
+# when the receive thread processes and notifies per packet and per batch.
+# Packets are handed to the network layer directly, so the link isn't measured.
+#
+# Logging should be disabled.
+#
+# Usage: python3 benchmarks/receive_batch.py <config file> [packets] [batch size]
+
+packets = 100000 if len(sys.argv) < 3 else int(sys.argv[2])
+batch_size = 32 if len(sys.argv) < 4 else int(sys.argv[3])
+
+# Experimental next header (RFC 3692), so nothing else receives these packets
+NEXT_HEADER = 253
+loc = network.locs_joined[0]
+
+header = codec.pack(
+    network.STATIC_MASKS_FIELD, 64, NEXT_HEADER, 255,
+    codec.hex_to_bytes("0:0:0:fe"),
+    codec.hex_to_bytes("ffff:0:0:fe"),
+    codec.hex_to_bytes(loc),
+    codec.hex_to_bytes(network.local_nid),
+)
+packet = header + bytes(64)
+# Received from another node
+from_addr = "benchmark"
+# Queue every packet, so the consumer falling behind isn't measured as drops
+network.queue_capacity = packets
+
+
+def consume():
+    cv = network.receive_cvs[NEXT_HEADER]
+    received = 0
+    while True:
+        with cv:
+            while True:
+                try:
+                    network.receive(NEXT_HEADER)
+                    received += 1
+                except (IndexError, KeyError):
+                    break
+            if received == packets:
+                return
+            cv.wait(0.01)
+
+
+def bench(size):
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    start = time.perf_counter()
+    for i in range(0, packets, size):
+        batch = [
+            (memoryview(bytearray(packet)), loc, from_addr)
+            for _ in range(min(size, packets - i))
+        ]
+        network._notify_receivers(network._receive_batch(batch))
+    consumer.join()
+    return packets / (time.perf_counter() - start)
+
+
+print("per packet     %10.0f pps" % bench(1))
+print("batch of %-5d %10.0f pps" % (batch_size, bench(batch_size)))
+os._exit(0)
@@ -0,0 +1,123 @@
+import struct
+from functools import lru_cache
+
+import util
+
+# Encoding and decoding of the ILNPv6 header.
+#
+# ILNPv6 header is of the form:
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |Version| Traffic Class |           Flow Label                  |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |         Payload Length        |  Next Header  |   Hop Limit   |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                                                               |
+# +                           Source Loc                          +
+# |                                                               |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                                                               |
+# +                           Source NID                          +
+# |                                                               |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                                                               |
+# +                        Destination Loc                        +
+# |                                                               |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                                                               |
+# +                        Destination NID                        +
+# |                                                               |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+#
+# Locators and NIDs are 8 byte bytes objects.
+# They are hex strings (e.g. "0:0:0:a") in configs, logs, and the transport API,
+# and are converted with hex_to_bytes and bytes_to_hex.
+
+# masked fields (version, traffic class, and flow label), payload length,
+# next header, hop limit, source loc, source nid, destination loc, destination nid
+HEADER = struct.Struct("!IHBB8s8s8s8s")
+
+HEADER_SIZE = HEADER.size
+
+# Offsets of fields in the header
+PAYLOAD_LENGTH_OFFSET = 4
+NEXT_HEADER_OFFSET    = 6
+HOP_LIMIT_OFFSET      = 7
+SRC_LOC_OFFSET        = 8
+SRC_NID_OFFSET        = 16
+DST_LOC_OFFSET        = 24
+DST_NID_OFFSET        = 32
+
+LOC_SIZE = 8
+NID_SIZE = 8
+
+_MASKED_FIELDS  = struct.Struct("!I")
+_PAYLOAD_LENGTH = struct.Struct("!H")
+
+
+def pack(masked_fields, payload_length, next_header, hop_limit, src_loc, src_nid, dst_loc, dst_nid):
+    return HEADER.pack(
+        masked_fields, payload_length, next_header, hop_limit,
+        src_loc, src_nid, dst_loc, dst_nid
+    )
+
+
+def pack_into(buffer, masked_fields, payload_length, next_header, hop_limit, src_loc, src_nid, dst_loc, dst_nid):
+    HEADER.pack_into(buffer, 0,
+        masked_fields, payload_length, next_header, hop_limit,
+        src_loc, src_nid, dst_loc, dst_nid
+    )
+
+
+# Decodes every field of the header at the start of packet
+def unpack(packet):
+    return HEADER.unpack_from(packet)
+
+
+# Decode single fields of the header at the start of packet,
+# for handlers that only need some of them
+
+def masked_fields(packet):
+    return _MASKED_FIELDS.unpack_from(packet)[0]
+
+def payload_length(packet):
+    return _PAYLOAD_LENGTH.unpack_from(packet, PAYLOAD_LENGTH_OFFSET)[0]
+
+def next_header(packet):
+    return packet[NEXT_HEADER_OFFSET]
+
+def hop_limit(packet):
+    return packet[HOP_LIMIT_OFFSET]
+
+def src_loc(packet):
+    return bytes(packet[SRC_LOC_OFFSET:SRC_LOC_OFFSET + LOC_SIZE])
+
+def src_nid(packet):
+    return bytes(packet[SRC_NID_OFFSET:SRC_NID_OFFSET + NID_SIZE])
+
+def dst_loc(packet):
+    return bytes(packet[DST_LOC_OFFSET:DST_LOC_OFFSET + LOC_SIZE])
+
+def dst_nid(packet):
+    return bytes(packet[DST_NID_OFFSET:DST_NID_OFFSET + NID_SIZE])
+
+
+# Encode single fields of the header at the start of packet, a writable buffer,
+# for reusing a header
+
+def set_payload_length(packet, payload_length):
+    _PAYLOAD_LENGTH.pack_into(packet, PAYLOAD_LENGTH_OFFSET, payload_length)
+
+def set_hop_limit(packet, hop_limit):
+    packet[HOP_LIMIT_OFFSET] = hop_limit
+
+
+# Conversions between hex string and binary locators and NIDs.
+# Cached, as a node sees few distinct locators and NIDs.
+
+@lru_cache(maxsize=4096)
+def hex_to_bytes(hexadecimal):
+    return util.hex_to_bytes(hexadecimal, 8)
+
+@lru_cache(maxsize=4096)
+def bytes_to_hex(binary):
+    return util.bytes_to_hex(binary)
@@ -1,135 +1,417 @@
 import struct
+import math
 import time
+import secrets
+import itertools
+import threading
 
+import codec
+import tables
 import util
 from util import NetworkException
 
 DISCOVERY_NEXT_HEADER = 43
 
-# hostname   -> [ (loc, nid, timestamp) ]
-host_map = {}
+# Discovery messages are of the form:
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                                                               |
+# +                              NID                              +
+# |                                                               |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |     Type      |     Flags     |  Added Count  | Removed Count |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                        Sequence Number                        |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                              TTL                              |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                            Version                            |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                                                               |
+# +              Added Locs (Added Count * 8 bytes)               +
+# |                                                               |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                                                               |
+# +            Removed Locs (Removed Count * 8 bytes)             +
+# |                                                               |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                  Hostname (variable length)                   |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+#
+# Every message advertises that the hostname can be reached at the NID
+# at each added locator, for TTL milliseconds.
+# The version is incremented each time the sender's set of locators changes.
+# A message is either of the sender's whole set, with no removed locators,
+# or if the DELTA flag is set, of the changes from the previous version.
+# So one message is sent for all of a node's locators, on each of them,
+# and copies after the first are recognised and dropped.
+# The sequence number is incremented for each message a node creates,
+# so copies of a flooded message can be recognised.
+# A query's hostname is followed by a null byte and the hostname queried.
+MESSAGE = struct.Struct("!8sBBBBIII")
 
-# (identifier, locator) -> (hostname, timestamp)
-inverse_host_map = {}
+LOC_SIZE = 8
 
+# Flags
+DELTA = 0x01
 
-def getaddrinfo(addr):
+# Message types.
+# Advertisements are flooded, or unicast in response to a query.
+ADVERTISEMENT = 0
+# Asks every node to advertise, flooded
+SOLITITATION = 1
+# Asks the node with the hostname queried to advertise to the querier, flooded
+QUERY = 2
+
+# Called with no arguments when a lookup misses, to solicit sooner. Set by network.
+miss_callback = None
+
+# Called with a hostname when a lookup of it misses and resolution is "query",
+# to query for it. Set by network.
+query_callback = None
+
+# Map of hostnames to when (time.monotonic) they were last queried for
+query_timestamps = {}
+
+# Notified when a mapping is learnt, for lookups waiting for a query to be answered
+learnt_cv = threading.Condition()
+
+# Sequence numbers of messages created, starting at random so that
+# messages sent after restarting aren't mistaken for ones sent before
+sequence_numbers = itertools.count(secrets.randbits(32))
+
+# This node's locators, the version of the set, and the locators
+# added and removed by the change to it, see set_local_locs
+local_locs = ()
+local_delta = (), ()
+# Starting at the time, so versions after restarting are newer than those before
+local_version = int(time.time() * 1000) & 0xffffffff
+
+# Map of NIDs to (latest version processed, when it expires (time.monotonic)),
+# changed under versions_lock
+versions = {}
+versions_lock = threading.Lock()
+
+# Called with a locator, returns the number of frames queued on the interface
+# it's reached through (math.inf if none). Set by network.
+queue_length_callback = None
+
+# Hostnames <-> ILVs, created by startup
+host_map = None
+
+# Round trip time and loss estimates of locators, measured by network
+locator_stats = tables.LocatorStats()
+# Round trip time assumed for locators whose loss has been measured but round trip time hasn't
+DEFAULT_RTT = 0.1
+# If locator_stats changed since resolutions were last invalidated, see record_received
+stats_changed = False
+
+
+# If hst isn't mapped, waits up to timeout seconds for it to be discovered,
+# e.g. for the answer to the query a miss sends
+def getaddrinfo(addr, timeout=None):
     hst, port = addr
-    entries = host_map.get(hst)
-    if entries != None:
-        valid_entries = []
-        for loc, nid, timestamp in entries:
-            if time.time() - timestamp < ttl:
-                valid_entries.append((loc, nid, timestamp))
-        if len(valid_entries) == 0:
-            host_map[hst] = None
-            valid_entries = None
-        elif len(entries) > len(valid_entries):
-            host_map[hst] = valid_entries
-        entries = valid_entries
-    if entries == None:
-        raise NetworkException("No mapping for hostname '%s'" % hst)
-    # TODO more sophisticated choice
-    entry = entries[0]
-    loc, nid, _ = entry
-    return ":".join([loc, nid]), port
+    ilv = host_map.resolve(hst)
+    if ilv == None:
+        _missed(hst)
+        if timeout != None:
+            with learnt_cv:
+                learnt_cv.wait_for(lambda: host_map.resolve(hst) != None, timeout)
+            ilv = host_map.resolve(hst)
+        if ilv == None:
+            raise NetworkException("No mapping for hostname '%s'" % hst)
+    return ilv, port
 
 
 def gethostbyaddr(addr):
     ilv, port = addr
-    entry = inverse_host_map.get(ilv)
-    if entry != None:
-        hst, timestamp = entry
-        # If mapping expired
-        if time.time() - timestamp > ttl:
-            inverse_host_map[ilv] = None
-            entry = None
-    if entry == None:
-        raise NetworkException("No mapping for addr '%s:%s'" % (loc, nid))
+    hst = host_map.hostname(ilv)
+    if hst == None:
+        _missed()
+        raise NetworkException("No mapping for addr '%s'" % ilv)
     return hst, port
 
 
-def get_solititation(loc, nid):
-    message = struct.pack("!8s8s?",
-        # implicit advertisement
-        util.hex_to_bytes(nid, 8),
-        util.hex_to_bytes(loc, 8),
-        # solititation
-        True,
-    )
-    # null terminated string
-    message += local_hst.encode("utf-8")
-    return message
+# Forget expired mappings, called periodically by network
+def expire():
+    host_map.expire()
+    global stats_changed
+    if stats_changed:
+        stats_changed = False
+        host_map.invalidate()
+    if resolution == "query":
+        # Query again for hostnames in use, i.e. looked up since last queried for,
+        # before their mappings expire
+        for hst in host_map.take_expiring(wait_time):
+            _missed(hst)
+
+
+# Returns [(hostname, loc bytes, nid bytes, seconds until expiry)] of the mappings hostnames resolve by
+def snapshot_entries():
+    entries = []
+    for hst, ilv, remaining in host_map.entries():
+        groups = ilv.split(":")
+        entries.append((
+            hst, codec.hex_to_bytes(":".join(groups[:4])), codec.hex_to_bytes(":".join(groups[4:])), remaining
+        ))
+    return entries
+
+
+# Learn mappings from snapshot_entries of a previous run. They're provisional,
+# expiring within max_ttl seconds unless confirmed by discovery messages.
+def load_snapshot_entries(entries, max_ttl):
+    for hst, loc_bytes, nid_bytes, remaining in entries:
+        # We learn our own mappings from our own messages
+        if hst == local_hst:
+            continue
+        ilv = ":".join([codec.bytes_to_hex(loc_bytes), codec.bytes_to_hex(nid_bytes)])
+        host_map.learn(hst, ilv, min(remaining, max_ttl))
+
+
+# Measurements of a locator, invalidating resolutions chosen by them
+def record_rtt(loc, rtt):
+    locator_stats.rtt_sample(loc, rtt)
+    if locator_selection == "rtt":
+        host_map.invalidate()
+
+
+def record_loss(loc, lost):
+    locator_stats.loss_sample(loc, lost)
+    if locator_selection == "rtt":
+        host_map.invalidate()
+
+
+# A packet was received from loc, after lost packets from it that never arrived,
+# e.g. as counted by transport sequence numbers. Received for every packet, so resolutions
+# are invalidated by the next expire rather than each time.
+def record_received(loc, lost):
+    if lost > 0:
+        locator_stats.loss_sample(loc, True, lost)
+    locator_stats.loss_sample(loc, False)
+    if locator_selection == "rtt":
+        global stats_changed
+        stats_changed = True
+
+
+# Locator selection policies, each choosing which of a hostname's ILVs it resolves to.
+# Given the ILVs in the order they were learnt, called with host_map locked.
+
+def _ilv_loc(ilv):
+    return ilv.rsplit(":", 4)[0]
+
+
+# Most recently refreshed by a discovery message
+def _select_recent(ilvs):
+    return max(ilvs, key=host_map.expiries.get)
+
+
+# Lowest round trip time, inflated by loss as lost packets take longer to get through.
+# Locators with only their loss measured are taken to have a round trip time of DEFAULT_RTT,
+# and those not yet measured are only chosen if none have been.
+def _select_rtt(ilvs):
+    best, best_cost = None, math.inf
+    for ilv in ilvs:
+        loc = _ilv_loc(ilv)
+        rtt = locator_stats.rtt(loc)
+        if rtt == None:
+            if loc not in locator_stats.losses:
+                continue
+            rtt = DEFAULT_RTT
+        cost = rtt / max(1 - locator_stats.loss(loc), 0.01)
+        if cost < best_cost:
+            best, best_cost = ilv, cost
+    if best == None:
+        return next(iter(ilvs))
+    return best
+
+
+# Fewest frames queued on the interface it's reached through
+def _select_queue(ilvs):
+    return min(ilvs, key=lambda ilv: queue_length_callback(_ilv_loc(ilv)))
+
+
+# name -> (select, cache, refresh_invalidates), see tables.HostMap
+LOCATOR_SELECTION_POLICIES = {
+    "first":  (None, True, False),
+    "recent": (_select_recent, True, True),
+    # Invalidated by record_rtt and record_loss
+    "rtt":    (_select_rtt, True, False),
+    # Queues change with every frame, so chosen on every lookup
+    "queue":  (_select_queue, False, False),
+}
 
 
-def get_advertisement(loc, nid):
-    message = struct.pack("!8s8s?",
-        util.hex_to_bytes(nid, 8),
-        util.hex_to_bytes(loc, 8),
-        # not solititation
-        False,
+# hst is the hostname looked up, if it was a hostname
+def _missed(hst=None):
+    if resolution == "query":
+        if hst == None or query_callback == None:
+            return
+        # Query at most once per min_wait_time for each hostname
+        now = time.monotonic()
+        if now - query_timestamps.get(hst, -math.inf) >= min_wait_time:
+            query_timestamps[hst] = now
+            query_callback(hst)
+    elif miss_callback != None:
+        miss_callback()
+
+
+# Set this node's locators, advertised by the messages created
+def set_local_locs(locs):
+    global local_locs, local_delta, local_version
+    added = tuple(loc for loc in locs if loc not in local_locs)
+    removed = tuple(loc for loc in local_locs if loc not in locs)
+    local_locs = tuple(locs)
+    local_delta = added, removed
+    local_version = (local_version + 1) & 0xffffffff
+
+
+def _get_message(message_type, nid, delta=False):
+    if delta:
+        flags = DELTA
+        added, removed = local_delta
+    else:
+        flags = 0
+        added, removed = local_locs, ()
+    message = MESSAGE.pack(
+        codec.hex_to_bytes(nid),
+        message_type,
+        flags,
+        len(added),
+        len(removed),
+        next(sequence_numbers) & 0xffffffff,
+        round(ttl * 1000),
+        local_version,
     )
+    message += b"".join(codec.hex_to_bytes(loc) for loc in added + removed)
     message += local_hst.encode("utf-8")
     return message
 
 
-def process_message(message, received_interface):
-    timestamp = time.time()
+def get_solititation(nid):
+    # implicit advertisement
+    return _get_message(SOLITITATION, nid)
+
+
+# If delta, advertises the last change to this node's locators rather than all of them
+def get_advertisement(nid, delta=False):
+    return _get_message(ADVERTISEMENT, nid, delta)
+
+
+def get_query(nid, hst):
+    # implicit advertisement, so the answer can be sent to us
+    return _get_message(QUERY, nid) + b"\0" + hst.encode("utf-8")
+
+
+def _hostname_offset(message):
+    added_count, removed_count = message[10], message[11]
+    return MESSAGE.size + (added_count + removed_count) * LOC_SIZE
+
+
+# Hostname queried by a query message
+def query_target(message):
+    return str(bytes(message[_hostname_offset(message):]).split(b"\0", 1)[1], "utf-8")
+
+
+# Returns True if message is a copy of one received recently,
+# e.g. flooded to us by more than one router, which has already been processed and forwarded
+def is_duplicate(message):
+    return seen_messages.check(_message_key(message))
+
+
+# Like is_duplicate, for messages received on locators being prewarmed (see network.prewarm_time).
+# Those are processed but not answered or forwarded, so are remembered apart from
+# seen_messages, or the same message arriving on a joined locator would be dropped.
+def is_prewarm_duplicate(message):
+    return prewarm_seen_messages.check(_message_key(message))
 
-    # 17 bytes of struct
-    message_struct = message[:17]
+
+def _message_key(message):
+    nid_bytes, message_type, flags, added_count, removed_count, sequence_number, message_ttl, version = \
+        MESSAGE.unpack_from(message)
+    return nid_bytes, sequence_number
+
+
+# Returns True if version of nid should be processed, remembering it as the latest if so.
+# Versions wrap, so are compared with serial number arithmetic (RFC 1982).
+# Deltas are also checked to be of the version after the latest, and if they
+# aren't the host map is inconsistent, as a change has been missed.
+def _check_version(nid, version, delta):
+    now = time.monotonic()
+    with versions_lock:
+        entry = versions.get(nid)
+        if entry != None and entry[1] > now:
+            difference = (version - entry[0]) & 0xffffffff
+            # Older
+            if difference >= 0x80000000:
+                return False
+            # Already processed, though whole sets refresh their mappings
+            if difference == 0 and delta:
+                return False
+            consistent = not delta or difference == 1
+        else:
+            consistent = not delta
+        versions[nid] = version, now + ttl
+    if not consistent:
+        _missed()
+    return True
+
+
+# Learns the mappings message advertises, and returns the message's type
+def process_message(message, received_interface):
     (
         nid_bytes,
-        loc_bytes,
-        solititation,
-    ) = struct.unpack("!8s8s?", message_struct)
-    nid = util.bytes_to_hex(nid_bytes)
-    loc = util.bytes_to_hex(loc_bytes)
-    hst = message[17:].decode("utf-8")
-
-    ilv = ":".join([loc, nid])
-    
-    inverse_host_map[ilv] = hst, timestamp
-    
-    entries = host_map.get(hst)
-    if entries == None:
-        host_map[hst] = [(loc, nid, timestamp)]
+        message_type,
+        flags,
+        added_count,
+        removed_count,
+        sequence_number,
+        message_ttl,
+        version,
+    ) = MESSAGE.unpack_from(message)
+    nid = codec.bytes_to_hex(nid_bytes)
+    delta = flags & DELTA != 0
+    if not _check_version(nid, version, delta):
+        return message_type
+
+    offset = MESSAGE.size
+    ilvs = []
+    for i in range(added_count + removed_count):
+        loc = codec.bytes_to_hex(bytes(message[offset:offset + LOC_SIZE]))
+        ilvs.append(":".join([loc, nid]))
+        offset += LOC_SIZE
+    added, removed = ilvs[:added_count], ilvs[added_count:]
+    hostname_bytes = bytes(message[offset:])
+    if message_type == QUERY:
+        hostname_bytes = hostname_bytes.split(b"\0", 1)[0]
+    hst = str(hostname_bytes, "utf-8")
+
+    # Cached for as long as the sender says the mappings are valid.
+    # A whole set replaces the host's ILVs with this NID.
+    if delta:
+        new = host_map.update(hst, removed, added, message_ttl / 1000)
     else:
-        already_mapped = False
-        for i in range(len(entries)):
-            l, n, _ = entries[i]
-            if l == loc and n == nid:
-                already_mapped = True
-                # update timestamp
-                entries[i] = loc, nid, timestamp
-                break
-        if not already_mapped:
-            entries.append((loc, nid, timestamp))
-        host_map[hst] = entries
+        new = host_map.update(hst, (), added, message_ttl / 1000, replace_nid=nid)
+    if new:
+        with learnt_cv:
+            learnt_cv.notify_all()
 
     if log_file != None:
         util.write_log(log_file, "\n\t%s\n\t%s" % (
-            "%s => %s" % (hst, host_map[hst]),
-            "%s:%s => %s" % (loc, nid, inverse_host_map[ilv])
+            "%s => %s" % (hst, host_map.ilvs(hst)),
+            "%s (version %d) +%s -%s" % (nid, version, added, removed)
         ))
 
-    return solititation
+    return message_type
 
 
 # Update host coresponding to (loc, nid) if it exists
 def locator_update(loc, nid, new_locs):
-    ilv = ":".join([loc, nid])
-    timestamp = time.time()
-    entry = inverse_host_map.get(ilv)
-    if entry != None:
-        hst, _ = entry
-        host_map[hst] = [(loc, nid, timestamp) for loc in new_locs]
-        inverse_host_map[ilv] = None
-        for loc in new_locs:
-            inverse_host_map[ilv] = hst, timestamp
+    hst = host_map.hostname(":".join([loc, nid]))
+    if hst != None:
+        # The host's ILVs with this NID are replaced by ones at the new locators
+        host_map.update(hst, (), [":".join([l, nid]) for l in new_locs], replace_nid=nid)
         if log_file != None:
             util.write_log(log_file, "\n\t%s" % (
-                "%s => %s" % (nid, host_map[hst])
+                "%s => %s" % (nid, host_map.ilvs(hst))
             ))
 
 
@@ -151,3 +433,49 @@ def startup():
         wait_time = 30
     # discovery TTL is 3 times the wait time
     ttl = 3 * wait_time
+
+    # How hostnames are resolved:
+    #  "flood" for every node soliciting and advertising to every other node, or
+    #  "query" for nodes querying for the hostnames they look up, and only those answering
+    global resolution
+    if "resolution" in config_section:
+        resolution = config_section["resolution"]
+    else:
+        resolution = "flood"
+    if resolution not in ("flood", "query"):
+        raise NetworkException("Unknown resolution '%s'" % resolution)
+
+    # Which of a multihomed host's ILVs to send to, see LOCATOR_SELECTION_POLICIES
+    global locator_selection
+    if "locator_selection" in config_section:
+        locator_selection = config_section["locator_selection"]
+    else:
+        locator_selection = "first"
+    if locator_selection not in LOCATOR_SELECTION_POLICIES:
+        raise NetworkException("Unknown locator selection policy '%s'" % locator_selection)
+    select, cache, refresh_invalidates = LOCATOR_SELECTION_POLICIES[locator_selection]
+
+    global host_map
+    host_map = tables.HostMap(ttl, select, cache, refresh_invalidates)
+
+    # Time between sending solititations after an inconsistency, such as
+    # a lookup missing or joining a locator, doubling up to wait_time while consistent
+    global min_wait_time
+    if "min_wait_time" in config_section:
+        min_wait_time = config_section.getfloat("min_wait_time")
+    else:
+        min_wait_time = wait_time / 32
+
+    # Number of other nodes' solititations heard that suppress our own
+    global redundancy
+    if "redundancy" in config_section:
+        redundancy = config_section.getint("redundancy")
+    else:
+        redundancy = 1
+
+    # Messages recently received, for recognising copies of flooded messages.
+    # Copies arrive within a few hops' latency of each other, and sequence numbers
+    # aren't reused, so wait_time is ample.
+    global seen_messages, prewarm_seen_messages
+    seen_messages = tables.SeenCache(wait_time)
+    prewarm_seen_messages = tables.SeenCache(wait_time)
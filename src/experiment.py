@@ -3,6 +3,7 @@ import sys
 import time
 from datetime import datetime
 
+import network
 import transport
 import util
 import discovery
@@ -39,9 +40,9 @@ def experiment(local, remote, run_time, wait_time):
                 # discovery.getaddrinfo returns (ilv, port)
                 remote_addrinfo = discovery.getaddrinfo(remote)
                 local_addrinfo = discovery.getaddrinfo(local)
-                # MTU - header size = 1440 - 44 = 1396
-                # 1396 - 8 = 1388
-                data=util.int_to_bytes(i, 8) + f.read(1388)
+                # MTU - header size = 1440 - 52 = 1388
+                # 1388 - 8 = 1380
+                data=util.int_to_bytes(i, 8) + f.read(1380)
                 interface = sock.send(remote_addrinfo, data)
                 print("%s %-40s <- %-40s %d %d" % (
                     datetime.now(),
@@ -136,6 +137,7 @@ def experiment(local, remote, run_time, wait_time):
     
     print("Total bytes: %d" % total_bytes)
     print("Bytes/sec: %d" % (total_bytes / (now - start)))
+    network.shutdown()
     os._exit(0)
 
 
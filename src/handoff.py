@@ -0,0 +1,102 @@
+import math
+import time
+
+# Handoff policies, deciding when a moving node moves and which locators it moves to.
+#
+# A policy is polled by network.Mover with the locators currently joined. poll returns
+# (locators to move to now, or None to stay, seconds until poll should next be called).
+# Policies that know their next move in advance also return it from predict,
+# so the next locators can be joined ahead of it (see network.prewarm_time).
+
+
+# Moves through the sets of locators in loc_cycle in turn, every move_time seconds
+class CyclePolicy:
+    def __init__(self, loc_cycle, move_time):
+        self.loc_cycle = loc_cycle
+        self.move_time = move_time
+        self.loc_cycle_index = 0
+        # When (time.time) to move next
+        self.next_move_time = time.time() + move_time
+
+    def poll(self, current):
+        now = time.time()
+        if now < self.next_move_time:
+            return None, self.next_move_time - now
+        self.loc_cycle_index = (self.loc_cycle_index + 1) % len(self.loc_cycle)
+        # Moves that were held up (e.g. by a long handoff) aren't caught up on
+        self.next_move_time = max(self.next_move_time + self.move_time, now)
+        return self.loc_cycle[self.loc_cycle_index], self.next_move_time - now
+
+    # Returns (locators, time (time.time) of the move) of the next move
+    def predict(self, current):
+        next_index = (self.loc_cycle_index + 1) % len(self.loc_cycle)
+        return self.loc_cycle[next_index], self.next_move_time
+
+
+# Moves to the set of locators in loc_cycle whose paths are best, once they have been
+# better than the current set's by margin (a fraction of its cost) for hold_time seconds,
+# and at least min_dwell seconds after the last move, so it doesn't flap between sets
+# with similar costs.
+#
+# metrics is called with a locator, and returns (smoothed round trip time or None,
+# loss rate, frames queued) of the path through it, or None if it hasn't been measured.
+# A locator's cost is its round trip time, inflated by its loss rate and queue,
+# and a set's cost is that of its best locator. Locators not joined keep the cost they
+# were last measured at, and those never measured are assumed to be lossless with
+# a round trip time of DEFAULT_RTT, so a degrading path is left for one not tried yet.
+class HysteresisPolicy:
+    # Round trip time assumed for locators whose round trip time hasn't been measured
+    DEFAULT_RTT = 0.1
+
+    def __init__(self, loc_cycle, metrics, margin=0.2, hold_time=2, min_dwell=0, poll_interval=0.5):
+        self.loc_cycle = loc_cycle
+        self.metrics = metrics
+        self.margin = margin
+        self.hold_time = hold_time
+        self.min_dwell = min_dwell
+        self.poll_interval = poll_interval
+        self.last_move_time = time.time()
+        # Set better than the current one by margin, and since when (time.time)
+        self.candidate = None
+        self.candidate_since = None
+
+    def _cost(self, locs):
+        costs = []
+        for loc in locs:
+            metrics = self.metrics(loc)
+            if metrics == None:
+                metrics = None, 0, 0
+            rtt, loss, queue = metrics
+            if rtt == None:
+                rtt = self.DEFAULT_RTT
+            # A path losing everything is only as bad as one losing 99%
+            costs.append(rtt * (1 + queue) / max(1 - loss, 0.01))
+        return min(costs)
+
+    def poll(self, current):
+        now = time.time()
+        current_cost = self._cost(current)
+        best = None
+        best_cost = math.inf
+        for index, locs in enumerate(self.loc_cycle):
+            if list(locs) == list(current):
+                continue
+            cost = self._cost(locs)
+            if cost < best_cost:
+                best, best_cost = index, cost
+
+        if best == None or best_cost >= current_cost * (1 - self.margin):
+            self.candidate = None
+            return None, self.poll_interval
+        if best != self.candidate:
+            self.candidate = best
+            self.candidate_since = now
+        if now - self.candidate_since < self.hold_time or now - self.last_move_time < self.min_dwell:
+            return None, self.poll_interval
+
+        self.candidate = None
+        self.last_move_time = now
+        return self.loc_cycle[best], self.poll_interval
+
+    def predict(self, current):
+        return None
@@ -56,7 +56,7 @@ def heartbeat():
                             src_addrinfo[1]  # port
                         ),
                         "[%s/%s]:%d" % (dst_host, *dst_addrinfo),
-                        message.decode("utf-8")
+                        str(message, "utf-8")
                 ))
             except transport.NetworkException as e:
                 break
@@ -3,21 +3,33 @@ import struct
 import os
 
 import util
+import sim_link
 
-joined_mcast_grps = set()
+# Must have prefix ff00::/8 for multicast.
+# The next 4 bits are flags. Transient/non-perminant is denoted by 1.
+# The final 4 bits are for the scope. Link-local is denoted by 2.
+MCAST_PREFIX = "ff12"
 
+# Ancillary data buffer for IPV6_PKTINFO data item of 20 bytes:
+#  16 bytes for to_address and 4 bytes for interface_id
+ANCDATA_SIZE = socket.CMSG_SPACE(20)
 
-# Transforms locators into a multicast address (an interface in our overlay network).
-# loc should be a 64 bit hex string
-def _get_mcast_grp(loc):    
-    # 16 bit hex representation of user ID (modulo 2^16)
-    uid_hex = format(os.getuid() % 65536, "x")
+# Map of joined interfaces (locators) to (mcast_grp, sockaddr, mreq).
+# Resolved once on join so that sending is a single lookup.
+interfaces = {}
+
+# Map of joined interfaces to their own socket, if sharded.
+# Each is bound to the interface's multicast group so receives only its packets.
+socks = {}
+
+# Map of binary multicast group addresses (struct in6_addr) to joined interfaces.
+# Used to map the destination of received packets back to an interface.
+grp_to_interface = {}
 
-    # Must have prefix ff00::/8 for multicast.
-    # The next 4 bits are flags. Transient/non-perminant is denoted by 1.
-    # The final 4 bits are for the scope. Link-local is denoted by 2.
-    mcast_prefix = "ff12"
 
+# Transforms locators into a multicast address (an interface in our overlay network).
+# loc should be a 64 bit hex string
+def _get_mcast_grp(loc):
     # Multicast group address is of the form:
     # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     # |        Multicast Prefix       |             UNUSED            |
@@ -29,39 +41,16 @@ def _get_mcast_grp(loc):
     # |                                                               |
     # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     return "%s:0:%s:0:%s%%%s" % (
-        mcast_prefix,
+        MCAST_PREFIX,
         uid_hex,
         loc,
         mcast_interface
     )
 
 
-def send(interface, data):
+# Resolves an interface to its multicast group, socket address, and in6_mreq.
+def _resolve(interface):
     mcast_grp = _get_mcast_grp(interface)
-    if mcast_grp not in joined_mcast_grps:
-        raise IOError("Not joined multicast group '%s'" % mcast_grp)
-    (family, socktype, proto, canonname, sockaddr) = socket.getaddrinfo(
-        mcast_grp, mcast_port,
-        family=socket.AF_INET6, type=socket.SOCK_DGRAM
-    )[0]
-    # If data larger than buffer size data will be truncated
-    if len(data) > buffer_size:
-        raise IOError("data length larger than buffer size: %d > %d" %
-            (len(data), buffer_size)
-        )
-    if log_file != None:
-        util.write_log(log_file, "%-45s <- %-45s %s" % (
-            "[%s]:%d" % (mcast_grp.split("%")[0], mcast_port),
-            "[%s]:%d" % (local_addr, mcast_port),
-            (str(data[:61]) + "...") if len(data) > 64 else data
-        ))
-    sock.sendto(data, sockaddr)
-
-
-def join(interface):
-    mcast_grp = _get_mcast_grp(interface)
-    if mcast_grp in joined_mcast_grps:
-        raise IOError("Already joined multicast group '%s'" % mcast_grp)
     (family, socktype, proto, canonname, sockaddr) = socket.getaddrinfo(
         mcast_grp, mcast_port,
         family=socket.AF_INET6, type=socket.SOCK_DGRAM
@@ -78,50 +67,94 @@ def join(interface):
     # 16s = 16 chars (bytes) for mcast_group_bin
     # i = signed int for scope_id
     mreq = struct.pack("16si", mcast_group_bin, scope_id)
-    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+    return mcast_grp, sockaddr, mreq
 
-    joined_mcast_grps.add(mcast_grp)
 
+# Sends the concatenation of buffers (bytes like objects) as one packet,
+# gathered by the kernel rather than copied into one.
+def send(interface, *buffers):
+    entry = interfaces.get(interface)
+    if entry == None:
+        raise IOError("Not joined interface '%s'" % interface)
+    # If data larger than buffer size data will be truncated
+    length = sum(map(len, buffers))
+    if length > buffer_size:
+        raise IOError("data length larger than buffer size: %d > %d" %
+            (length, buffer_size)
+        )
+    mcast_grp, sockaddr, mreq = entry
     if log_file != None:
-        util.write_log(log_file, ("Joined %s" % mcast_grp))
+        util.write_log(log_file, "%-45s <- %-45s %s" % (
+            "[%s]:%d" % (mcast_grp.split("%")[0], mcast_port),
+            "[%s]:%d" % (local_addr, mcast_port),
+            util.format_data(list(buffers), 64)
+        ))
+    sock.sendmsg(buffers, (), 0, sockaddr)
 
 
-def leave(interface):
-    mcast_grp = _get_mcast_grp(interface)
-    if mcast_grp not in joined_mcast_grps:
-        raise IOError("Not joined multicast group '%s'" % mcast_grp)
-    (family, socktype, proto, canonname, sockaddr) = socket.getaddrinfo(
-        mcast_grp, mcast_port,
-        family=socket.AF_INET6, type=socket.SOCK_DGRAM
-    )[0]
-    (mcast_addr, mcast_sock_port, flow_info, scope_id) = sockaddr
+def join(interface):
+    if interface in interfaces:
+        raise IOError("Already joined interface '%s'" % interface)
+    mcast_grp, sockaddr, mreq = _resolve(interface)
+    if sharded:
+        join_sock = _create_interface_socket(sockaddr)
+        socks[interface] = join_sock
+    else:
+        join_sock = sock
+    join_sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+
+    interfaces[interface] = mcast_grp, sockaddr, mreq
+    # First 16 bytes of in6_mreq are the group address
+    grp_to_interface[mreq[:16]] = interface
 
-    # Remove interface suffix
-    mcast_addr = mcast_addr.split("%")[0]
-    # Binary representation of mcast_addr. Corresponds to struct in6_addr.
-    mcast_group_bin = socket.inet_pton(socket.AF_INET6, mcast_addr)
+    if log_file != None:
+        util.write_log(log_file, ("Joined %s" % mcast_grp))
 
-    # Corresponds to struct in6_mreq
-    # with multicast group and interface id in binary representations.
-    # 16s = 16 chars (bytes) for mcast_group_bin
-    # i = signed int for scope_id
-    mreq = struct.pack("16si", mcast_group_bin, scope_id)
-    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_LEAVE_GROUP, mreq)
 
-    joined_mcast_grps.remove(mcast_grp)
+def leave(interface):
+    entry = interfaces.pop(interface, None)
+    if entry == None:
+        raise IOError("Not joined interface '%s'" % interface)
+    mcast_grp, sockaddr, mreq = entry
+    if sharded:
+        leave_sock = socks.pop(interface)
+        leave_sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_LEAVE_GROUP, mreq)
+        # Wakes up the thread receiving on this socket.
+        # Linux does this for unconnected UDP sockets, but reports ENOTCONN.
+        try:
+            leave_sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        leave_sock.close()
+    else:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_LEAVE_GROUP, mreq)
+    grp_to_interface.pop(mreq[:16], None)
 
     if log_file != None:
         util.write_log(log_file, ("Removed %s" % mcast_grp))
 
 
-def receive():
-    # buffer_size byte buffer and therefor max message size
-    # Ancillary data buffer for IPV6_PKTINFO data item of 20 bytes:
-    #  16 bytes for to_address and 4 bytes for interface_id
-    data, ancdata, msg_flags, from_address = sock.recvmsg(
-        buffer_size, socket.CMSG_SPACE(20)
-    )
-
+# Sends a list of (interface, *buffers) frames
+def send_batch(frames):
+    # Per frame logging is done by send
+    if log_file != None:
+        for interface, *buffers in frames:
+            send(interface, *buffers)
+        return
+    sendmsg = sock.sendmsg
+    for interface, *buffers in frames:
+        entry = interfaces.get(interface)
+        if entry == None:
+            raise IOError("Not joined interface '%s'" % interface)
+        length = sum(map(len, buffers))
+        if length > buffer_size:
+            raise IOError("data length larger than buffer size: %d > %d" %
+                (length, buffer_size)
+            )
+        sendmsg(buffers, (), 0, entry[1])
+
+
+def _parse(nbytes, ancdata, from_address):
     assert len(ancdata) == 1
     cmsg_level, cmsg_type, cmsg_data = ancdata[0]
     assert cmsg_level == socket.IPPROTO_IPV6
@@ -129,35 +162,193 @@ def receive():
     # Destination IP address of packet (multicast group),
     # and the ID of the interface it was received on.
     to_address, interface_id = struct.unpack("16si", cmsg_data)
-    
-    # Gets IPv6 address and port the packet was sent from
-    from_ip, from_port = socket.getnameinfo(from_address,
-        (socket.NI_NUMERICHOST | socket.NI_NUMERICSERV)
-    )
-    from_ip_without_interface = from_address[0]
 
-    mcast_grp = util.bytes_to_hex(to_address)
+    # Gets IPv6 address the packet was sent from
+    from_ip_without_interface = from_address[0]
 
     # Extract locator the packet was recived from from multicast group
-    recived_interface = util.bytes_to_hex(to_address[8:16])
+    recived_interface = grp_to_interface.get(to_address)
+    if recived_interface == None:
+        # Not (or no longer) joined, e.g. after leaving during a handoff
+        recived_interface = util.bytes_to_hex(to_address[8:16])
+
+    # Packet was received into receive_buffer
+    data = receive_buffer.take(nbytes)
 
     if log_file != None:
         util.write_log(log_file, "%-45s -> %-45s %s" % (
-            "[%s]:%s" % (from_ip_without_interface, from_port),
-            "[%s]:%d" % (mcast_grp, mcast_port),
-            (str(data[:61]) + "...") if len(data) > 64 else data
+            "[%s]:%s" % (from_ip_without_interface, from_address[1]),
+            "[%s]:%d" % (util.bytes_to_hex(to_address), mcast_port),
+            util.format_data(data, 64)
         ))
     return data, recived_interface, from_ip_without_interface
 
 
+# Let the memory of a received packet be reused, once it's no longer referenced
+def release(data):
+    receive_buffer.release(data)
+
+
+# Socket to receive on, which is the interface's own socket if sharded
+def _get_receive_socket(interface):
+    if interface == None:
+        return sock
+    receive_sock = socks.get(interface)
+    if receive_sock == None:
+        raise EOFError("Not joined interface '%s'" % interface)
+    return receive_sock
+
+
+def _receive(receive_sock, interface):
+    # buffer_size byte buffer and therefor max message size
+    try:
+        nbytes, ancdata, msg_flags, from_address = receive_sock.recvmsg_into(
+            [receive_buffer.get()[:buffer_size]], ANCDATA_SIZE
+        )
+    except OSError:
+        # The socket was closed by leave
+        if interface != None and receive_sock.fileno() == -1:
+            raise EOFError("Left interface '%s'" % interface)
+        raise
+    # The socket was shut down by leave
+    if len(ancdata) == 0 and interface != None:
+        raise EOFError("Left interface '%s'" % interface)
+    return _parse(nbytes, ancdata, from_address)
+
+
+# interface must be given if sharded, to receive from that interface's socket.
+# Raises EOFError once the interface is left.
+def receive(interface=None):
+    return _receive(_get_receive_socket(interface), interface)
+
+
+# Appends packets that are ready to batch without blocking, up to batch_size
+def _receive_ready(receive_sock, batch):
+    recvmsg_into = receive_sock.recvmsg_into
+    while len(batch) < batch_size:
+        try:
+            nbytes, ancdata, msg_flags, from_address = recvmsg_into(
+                [receive_buffer.get()[:buffer_size]], ANCDATA_SIZE, socket.MSG_DONTWAIT
+            )
+        except BlockingIOError:
+            break
+        batch.append(_parse(nbytes, ancdata, from_address))
+    return batch
+
+
+# Received packets are memoryviews, which remain valid as long as they're referenced.
+# Blocks until a packet is received, then drains up to batch_size packets
+# that are ready without blocking.
+# Returns a list of (data, recived_interface, from_ip) tuples.
+def receive_batch(interface=None):
+    receive_sock = _get_receive_socket(interface)
+    return _receive_ready(receive_sock, [_receive(receive_sock, interface)])
+
+
+# As receive_batch, but never blocks, so returns an empty list if no packets are ready.
+# For event loops, which wait for receive_socket(interface) to be readable.
+def receive_ready(interface=None):
+    return _receive_ready(_get_receive_socket(interface), [])
+
+
+# Socket that receive_batch(interface) and receive_ready(interface) receive from
+def receive_socket(interface=None):
+    return _get_receive_socket(interface)
+
+
+# Number of frames queued for transmission on interface.
+# All interfaces are sent on one socket, whose queue is the kernel's and isn't per interface,
+# so this is always 0.
+def queue_length(interface):
+    return 0
+
+
+def _create_interface_socket(sockaddr):
+    interface_sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    # Set to blocking
+    interface_sock.settimeout(None)
+    # Allow a socket per interface on mcast_port
+    interface_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    interface_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # Bind to the interface's multicast group and mcast_port,
+    # so that only packets sent to this interface are received on it
+    interface_sock.bind(sockaddr)
+    # Set the delivery of IPV6_PKTINFO control message on incoming datagrams
+    interface_sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
+    return interface_sock
+
+
+# Replace this module's link layer operations with those of another backend
+def _use_backend(module):
+    module.startup()
+
+    global send, send_batch, join, leave, receive, receive_batch, receive_ready, receive_socket, release
+    global queue_length
+    send           = module.send
+    send_batch     = module.send_batch
+    join           = module.join
+    leave          = module.leave
+    receive        = module.receive
+    receive_batch  = module.receive_batch
+    receive_ready  = module.receive_ready
+    receive_socket = module.receive_socket
+    release        = module.release
+    queue_length   = module.queue_length
+
+    global local_addr, buffer_size, batch_size
+    local_addr  = module.local_addr
+    buffer_size = module.buffer_size
+    batch_size  = module.batch_size
+
+
 def startup():
     config_section = util.config["link"]
-    
+
+    # If each joined interface has its own socket, see socket_per_locator below
+    global sharded
+    sharded = False
+
+    # Link layer emulation to use:
+    #  "multicast" for UDP over IPv6 multicast, or
+    #  "simulated" for many nodes on one host without multicast (see sim_link)
+    global backend
+    if "backend" in config_section:
+        backend = config_section["backend"]
+    else:
+        backend = "multicast"
+    if backend == "simulated":
+        _use_backend(sim_link)
+        return
+    elif backend != "multicast":
+        raise IOError("Unknown link backend '%s'" % backend)
+
     global mcast_port, mcast_interface, buffer_size
     mcast_port      = config_section.getint("mcast_port")
     mcast_interface = config_section["mcast_interface"]
     buffer_size     = config_section.getint("buffer_size")
 
+    # Packets are received into this, and passed up the stack without copying
+    global receive_buffer
+    receive_buffer = util.ReceiveBuffer(buffer_size)
+
+    # Maximum number of packets received per receive_batch call
+    global batch_size
+    if "batch_size" in config_section:
+        batch_size = config_section.getint("batch_size")
+    else:
+        batch_size = 1
+
+    # Open a socket for each joined interface, to be received from by a thread each.
+    # Otherwise all interfaces are received from one socket.
+    # The threads share one process and its GIL, so this overlaps their waiting
+    # on the sockets, but doesn't process packets on more than one core.
+    if "socket_per_locator" in config_section:
+        sharded = config_section.getboolean("socket_per_locator")
+
+    global uid_hex
+    # 16 bit hex representation of user ID (modulo 2^16)
+    uid_hex = format(os.getuid() % 65536, "x")
+
     # Create a datagram (UDP) socket
     global sock
     sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
@@ -165,10 +356,13 @@ def startup():
     sock.settimeout(None)
     # Set time-to-live to 1
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
-    # Bind to mcast_port
-    sock.bind(("", mcast_port))
-    # Set the delivery of IPV6_PKTINFO control message on incoming datagrams
-    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
+    # If sharded this socket is only used for sending,
+    # and packets are received on each interface's socket
+    if not sharded:
+        # Bind to mcast_port
+        sock.bind(("", mcast_port))
+        # Set the delivery of IPV6_PKTINFO control message on incoming datagrams
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
 
     global local_addr
     # from https://stackoverflow.com/questions/24196932/how-can-i-get-the-ip-address-from-nic-in-python
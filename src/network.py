@@ -1,13 +1,22 @@
 import struct
+import math
 import os
 import secrets
+import itertools
 import collections
 import threading
+import asyncio
 import time
-import random
+import signal
 
 import link
 import discovery
+import codec
+import tables
+import trickle
+import retransmit
+import handoff
+import snapshot
 import util
 from util import NetworkException
 from collections import defaultdict
@@ -23,7 +32,7 @@ FLOW_LABEL_MASK     = 0x000fffff
 # static header fields
 VERSION = 0         # not used
 TRAFFIC_CLASS = 0   # not used
-FLOW_LABEL = 0      # not used
+FLOW_LABEL = 0      # packets not in a flow, see new_flow_label
 
 STATIC_MASKS_FIELD = (
     VERSION         << VERSION_SHIFT        |
@@ -32,126 +41,464 @@ STATIC_MASKS_FIELD = (
 )
 
 ALL_NODES_LOC = "ff02:0:0:1"
+ALL_NODES_LOC_BYTES = codec.hex_to_bytes(ALL_NODES_LOC)
 
 LOC_UPDATE_NEXT_HEADER = 44
 
-# Map of input circular queues indexed by next header
+# Locator update message types, the first byte of the message.
+# An update is followed by the new locators, and a scheduled update by the
+# milliseconds until it takes effect (32 bit) and then the new locators.
+LOC_UPDATE_ACK = 0
+LOC_UPDATE = 1
+SCHEDULED_LOC_UPDATE = 2
+SCHEDULED_LOC_UPDATE_HEADER = struct.Struct("!BI")
+
+# Map of input queues (util.PacketQueue) indexed by next header
 in_queues = {}
 
-# Map of locators to interfaces (which are locators than this node has joined),
-# and timestamps (seconds since epoch).
-# Populated by backwards learning.
-loc_to_interface = {}
+# Condition variables notified when packets are added to in_queues, by next header
+# cv = conditional value
+receive_cvs = defaultdict(threading.Condition)
+
+# Map of next headers to protocol handlers, see register_handler.
+# Packets with a handler are passed to it rather than added to in_queues.
+handlers = {}
+
+# Functions called every forwarding table tick, see register_expiry
+expiry_handlers = []
+
+# Forwarding table, mapping binary locators to interfaces (which are locators this node has joined).
+# Populated by backwards learning, and created on startup, see tables.ForwardingTable.
+loc_to_interface = None
+
+# Binary locators of locs_joined
+locs_joined_bytes = frozenset()
+
+# Number of packets forwarded, for sampling them in logs
+forwarded_count = 0
+
+# When (time.monotonic) we last advertised in response to a solititation
+advertisement_timestamp = 0
+
+# When (time.monotonic) we last solicited for a route to a pending packet,
+# with discovery's "query" resolution, see _solicit_route
+route_solititation_timestamp = -math.inf
+
+# Map of binary locators with no interface mapping to packets waiting for one, as
+# (time the first was queued (time.monotonic), deque of (loc, nid, data, next_header)).
+# Changed under pending_lock, along with pending_counts.
+pending = {}
+pending_lock = threading.Lock()
+# Packets queued, sent once a mapping was learnt, and dropped as their destination's
+# queue was full or timed out
+pending_counts = {"queued": 0, "flushed": 0, "dropped": 0, "timed_out": 0}
 
-# Map of Identifier-Locator Vectors to timestamps.
+# Identifier-Locator Vectors and when they were last active, see tables.ActivityTable.
 # Keeps track of active unicast ILNP sessions
 # for determining where to send locator updates.
 # Active here means sent in the past active_uncast_session_ttl seconds.
-active_ilvs =   {}
+active_ilvs = tables.ActivityTable()
+
+# Retransmits the current locator update to each ILV until it acknowledges,
+# see retransmit.Retransmitter. Created on startup if moving.
+loc_updates = None
+
+# Round trip times and loss rates of the paths through each of our locators (interfaces),
+# for handoff policies. Round trip times are measured from locator update acknowledgements,
+# and loss rates from gaps in transport sequence numbers, see record_received.
+interface_stats = tables.LocatorStats()
+
+# Shortest time in seconds to wait for a locator update to be acknowledged before retransmitting
+MIN_LOC_UPDATE_TIMEOUT = 0.01
+
+# While moving with bicast, (interfaces being left, interfaces joined) of the soft handoff,
+# otherwise None. Replaced rather than changed, so other threads can read it.
+handoff_interfaces = None
+
+# Locators joined ahead of a move, which are learnt from but not yet used, see Mover.prewarm.
+# Replaced rather than changed, so other threads can iterate over it
+prewarm_interfaces = frozenset()
+
+# Map of binary locators to the interface in prewarm_interfaces they were learnt through,
+# to be switched to when the move happens
+prewarm_routes = {}
+
+# Source of flow labels, see new_flow_label
+flow_label_counter = itertools.count()
+
+# Route cache of flows, mapping flow labels to [loc, nid, interface, header,
+# forwarding table interfaces it was looked up in, tick last active, next header].
+# header is the ILNPv6 header of the flow's first packet.
+# An entry is valid while the forwarding table's mappings haven't changed since it was
+# looked up, and all are invalidated by locator updates and our moves.
+# Entries of idle flows are removed every tick, see is_idle.
+flow_routes = {}
+
+# Map of NIDs of nodes that sent us a locator update to
+# (locator they're leaving, when (time.monotonic) to stop bicasting to it), for bicast
+bicast_locs = {}
 
 
+# Interface is a locator that identifies the network to foward the packet to.
+# Expired mappings are removed by ExpiryThread, so this doesn't check timestamps.
 def map_locator_to_interface(loc):
-    # Interface is a locator that identifies the network to foward the packet to.
-    entry = loc_to_interface.get(loc)
-    if entry != None:
-        interface, timestamp = entry
-    else:
-        return None
-    # If mapping expired (timestamp == None means this is a non-expiring mapping)
-    if interface != None and timestamp != None and time.time() - timestamp > backwards_learning_ttl:
-        loc_to_interface[loc] = None
-        return None
-    else:
-        return interface
+    return loc_to_interface.lookup(codec.hex_to_bytes(loc))
 
 
-# Send packet, mapping nid to locator, and locator to interface.
-def send(loc, nid, data, next_header, interface=None):
+# Number of frames queued on the interface loc is reached through, for discovery's locator selection
+def _queue_length(loc):
+    interface = map_locator_to_interface(loc)
     if interface == None:
+        return math.inf
+    return link.queue_length(interface)
+
+
+# Returns a new flow label, for a flow of packets to one destination, e.g. a transport flow.
+# Labels are 20 bits, and not 0, which is for packets not in a flow.
+# They wrap, so the labels of flows with cached routes are skipped, unless all are.
+def new_flow_label():
+    for _ in range(FLOW_LABEL_MASK):
+        label = next(flow_label_counter) % FLOW_LABEL_MASK + 1
+        if label not in flow_routes:
+            break
+    return label
+
+
+# Send packet, mapping nid to locator, and locator to interface.
+# data is a bytes like object, or a list of them to be sent concatenated without copying.
+# Packets of a flow (see new_flow_label) reuse the route and header of its previous packet.
+# If there's no interface to loc the packet is queued until there is, and None is returned,
+# otherwise the interface the packet was sent on is.
+def send(loc, nid, data, next_header, interface=None, flow_label=FLOW_LABEL):
+    buffers = data if type(data) is list else [data]
+    routed = interface == None
+    if routed:
+        if flow_label != FLOW_LABEL:
+            route = flow_routes.get(flow_label)
+            if (
+                route != None and route[0] == loc and route[1] == nid
+                and route[4] is loc_to_interface.interfaces and route[6] == next_header
+            ):
+                return _send_flow(route, flow_label, buffers, next_header)
+        # Before the lookup, so a change during it invalidates the route cached
+        interfaces = loc_to_interface.interfaces
         interface = map_locator_to_interface(loc)
         if interface == None:
-            raise NetworkException("No interface to locator: %s" % loc)
+            _send_pending(loc, nid, data, next_header)
+            return None
+    header = _send_on(loc, nid, buffers, next_header, interface, flow_label)
+    if routed and flow_label != FLOW_LABEL:
+        flow_routes[flow_label] = [
+            loc, nid, interface, header, interfaces, loc_to_interface.tick, next_header
+        ]
+    # Only packets routed here are bicast,
+    # not those the caller chose an interface for, e.g. locator updates
+    if bicast and routed:
+        for bicast_loc, bicast_interface in _bicast_paths(loc, nid, interface):
+            _send_on(bicast_loc, nid, buffers, next_header, bicast_interface, flow_label)
+    # Don't count discovery and locator update messages as active
+    if loc != ALL_NODES_LOC:
+        active_ilvs.touch((loc, nid))
+    # Return interface packet sent on
+    return interface
+
+
+# Send a packet of a flow with a cached route, only writing its payload length
+# and hop limit into a copy of the flow's header.
+# Copied, as a flow may be sent on from more than one thread.
+def _send_flow(route, flow_label, buffers, next_header):
+    loc, nid, interface, header, interfaces, active_tick, next_header = route
+    header = bytearray(header)
+    payload_length = sum(map(len, buffers))
+    hop_limit      = default_hop_limit
+    codec.set_payload_length(header, payload_length)
+    codec.set_hop_limit(header, hop_limit)
+    if log_file != None:
+        _log_send(loc, nid, interface, payload_length, next_header, hop_limit, buffers)
+    link.send(interface, header, *buffers)
+    if bicast:
+        for bicast_loc, bicast_interface in _bicast_paths(loc, nid, interface):
+            _send_on(bicast_loc, nid, buffers, next_header, bicast_interface, flow_label)
+    # Active ILVs are only touched once per forwarding table tick, as their ttl is much longer
+    if active_tick != loc_to_interface.tick:
+        route[5] = loc_to_interface.tick
+        active_ilvs.touch((loc, nid))
+    return interface
+
+
+# Send a packet on interface, from it as our locator, returning its header
+def _send_on(loc, nid, buffers, next_header, interface, flow_label=FLOW_LABEL):
     local_loc = interface
-    # ILNPv6 header is of the form:
-    # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    # |Version| Traffic Class |           Flow Label                  |
-    # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    # |         Payload Length        |  Next Header  |   Hop Limit   |
-    # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    # |                                                               |
-    # +                           Source Loc                          +
-    # |                                                               |
-    # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    # |                                                               |
-    # +                           Source NID                          +
-    # |                                                               |
-    # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    # |                                                               |
-    # +                        Destination Loc                        +
-    # |                                                               |
-    # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    # |                                                               |
-    # +                        Destination NID                        +
-    # |                                                               |
-    # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    payload_length = len(data)
+    # ILNPv6 header, see codec
+    payload_length = sum(map(len, buffers))
     hop_limit      = default_hop_limit
-    header = struct.pack("!4s2sss8s8s8s8s",
-        STATIC_MASKS_FIELD.to_bytes(4, byteorder="big", signed=False),
-        util.int_to_bytes(payload_length, 2),
-        util.int_to_bytes(next_header,    1),
-        util.int_to_bytes(hop_limit,      1),
-        util.hex_to_bytes(local_loc,      8),
-        util.hex_to_bytes(local_nid,      8),
-        util.hex_to_bytes(loc,            8),
-        util.hex_to_bytes(nid,            8),
+    header = codec.pack(
+        STATIC_MASKS_FIELD | flow_label << FLOW_LABEL_SHIFT,
+        payload_length,
+        next_header,
+        hop_limit,
+        codec.hex_to_bytes(local_loc),
+        local_nid_bytes,
+        codec.hex_to_bytes(loc),
+        codec.hex_to_bytes(nid),
     )
     if log_file != None:
+        _log_send(loc, nid, interface, payload_length, next_header, hop_limit, buffers)
+    link.send(interface, header, *buffers)
+    return header
+
+
+def _log_send(loc, nid, interface, payload_length, next_header, hop_limit, buffers):
+    util.write_log(log_file, "%-45s <- %-30s %s %s" % (
+        ":".join([loc, nid]) + "%" + interface,
+        ":".join([interface, local_nid]),
+        "(%5d, %2d, %2d)" % (payload_length, next_header, hop_limit),
+        util.format_data(buffers, 32)
+    ))
+
+
+# Returns [(loc, interface)] to send copies of a packet to (loc, nid) on, besides interface,
+# while it or we are in a soft handoff. Packets on either path then get through
+# whichever path the other end has switched to, with duplicates dropped by the transport.
+def _bicast_paths(loc, nid, interface):
+    paths = []
+    # We're moving, so send from the locators on the other side of the handoff too
+    interfaces = handoff_interfaces
+    if interfaces != None:
+        leaving, joined = interfaces
+        if interface in leaving:
+            paths.append((loc, joined[0]))
+        elif interface in joined:
+            paths.append((loc, leaving[0]))
+    # The destination is moving, so send to the locator it's leaving too
+    entry = bicast_locs.get(nid)
+    if entry != None:
+        old_loc, end_time = entry
+        if time.monotonic() >= end_time:
+            bicast_locs.pop(nid, None)
+        elif old_loc != loc:
+            old_interface = map_locator_to_interface(old_loc)
+            if old_interface != None:
+                paths.append((old_loc, old_interface))
+    return paths
+
+
+# Queue a packet to loc until it has an interface, soliciting a route to it.
+# Like ARP, a few packets are held per destination, oldest dropped first.
+def _send_pending(loc, nid, data, next_header):
+    if pending_capacity == 0:
+        raise NetworkException("No interface to locator: %s" % loc)
+    # Copy, as the buffers may be reused before the packet is sent
+    if type(data) is list:
+        data = b"".join(data)
+    else:
+        data = bytes(data)
+    loc_bytes = codec.hex_to_bytes(loc)
+    with pending_lock:
+        entry = pending.get(loc_bytes)
+        new = entry == None
+        if new:
+            entry = time.monotonic(), collections.deque(maxlen=pending_capacity)
+            pending[loc_bytes] = entry
+        packets = entry[1]
+        if len(packets) == pending_capacity:
+            pending_counts["dropped"] += 1
+        packets.append((loc, nid, data, next_header))
+        pending_counts["queued"] += 1
+    # In case the route was learnt since it was looked up
+    if map_locator_to_interface(loc) != None:
+        _flush_pending(loc_bytes)
+    elif new:
+        _solicit_route(loc, nid)
+
+
+# Solicit a route to loc, so it's learnt by backwards learning from the reply.
+# If the host at the ILV is known it's queried for, and replies unicast to us,
+# otherwise we solicit all nodes: soon with "flood" resolution, and now with "query"
+# resolution, which has no solititation schedule, though at most once per min_wait_time.
+def _solicit_route(loc, nid):
+    hostname = discovery.host_map.hostname(":".join([loc, nid]))
+    if hostname != None:
+        _query(hostname)
+    elif discovery.resolution == "query":
+        global route_solititation_timestamp
+        now = time.monotonic()
+        if now - route_solititation_timestamp >= discovery.min_wait_time:
+            route_solititation_timestamp = now
+            _send_solititation()
+    else:
+        solititation_trickle.reset()
+
+
+# Send packets waiting for an interface to loc_bytes, if there are any, once a route to it
+# has been installed
+def _route_installed(loc_bytes):
+    if len(pending) > 0:
+        _flush_pending(loc_bytes)
+
+
+# Send packets waiting for an interface to loc_bytes, once it's been learnt
+def _flush_pending(loc_bytes):
+    with pending_lock:
+        entry = pending.pop(loc_bytes, None)
+    if entry == None:
+        return
+    for loc, nid, data, next_header in entry[1]:
+        try:
+            if send(loc, nid, data, next_header) != None:
+                with pending_lock:
+                    pending_counts["flushed"] += 1
+        except Exception as e:
+            if log_file != None:
+                util.write_log(log_file, "Error sending pending packet: %s" % e)
+
+
+# Drop packets that have waited longer than pending_timeout for an interface
+def _expire_pending():
+    now = time.monotonic()
+    with pending_lock:
+        for loc_bytes, (queued_time, packets) in list(pending.items()):
+            if now - queued_time >= pending_timeout:
+                del pending[loc_bytes]
+                pending_counts["timed_out"] += len(packets)
+                if log_file != None:
+                    util.write_log(log_file, "No route to %s, dropped %d pending packets" % (
+                        codec.bytes_to_hex(loc_bytes), len(packets)
+                    ))
+
+
+def pending_stats():
+    with pending_lock:
+        stats = dict(pending_counts)
+        stats["waiting"] = sum(len(packets) for _, packets in pending.values())
+    return stats
+
+
+# Called by the transport for each packet it receives on interface from src_loc,
+# with the number of packets it found lost since the last.
+# Measures both our locator (for handoff policies) and theirs (for locator selection).
+def record_received(interface, src_loc, lost):
+    if lost > 0:
+        interface_stats.loss_sample(interface, True, lost)
+    interface_stats.loss_sample(interface, False)
+    discovery.record_received(src_loc, lost)
+
+
+# Returns (smoothed round trip time or None, loss rate, frames queued) of the path through
+# our locator loc, or None if it hasn't been measured, for handoff policies
+def _locator_metrics(loc):
+    rtt = interface_stats.rtt(loc)
+    if rtt == None and loc not in interface_stats.losses:
+        return None
+    return rtt, interface_stats.loss(loc), link.queue_length(loc)
+
+
+# Seconds each ILV took to acknowledge the latest locator update,
+# or None if it didn't before being given up on. For ILVs that acknowledged
+# a scheduled locator update while prewarming, it's the seconds from when prewarming started.
+def handoff_stats():
+    if loc_updates == None:
+        return {}
+    return dict(loc_updates.completion_times)
+
+
+# locs_joined is replaced rather than changed, so other threads can iterate over it
+def _set_locs_joined(locs):
+    global locs_joined, locs_joined_bytes
+    locs_joined_bytes = frozenset(codec.hex_to_bytes(loc) for loc in locs)
+    locs_joined = tuple(locs)
+    discovery.set_local_locs(locs_joined)
+
+
+# Forward a packet not for us, classifying it from its binary header fields only.
+# The hop limit is decremented in place, and the memory the packet was
+# received into is then reused by the link layer for the next packet.
+def _forward(message, received_interface, dst_loc_bytes):
+    received_interface_bytes = codec.hex_to_bytes(received_interface)
+
+    # Joined ahead of a move, so learn the route back but don't forward it, as on the slow path
+    if received_interface in prewarm_interfaces and dst_loc_bytes != received_interface_bytes:
+        _prewarm_receive(
+            message[codec.HEADER_SIZE:], codec.next_header(message),
+            codec.src_loc(message), codec.src_nid(message), received_interface
+        )
+        return
+
+    # If received on a locator that we're not currently joined to, ignore.
+    if received_interface not in locs_joined and dst_loc_bytes != received_interface_bytes:
+        return
+
+    src_loc_bytes = codec.src_loc(message)
+    if src_loc_bytes not in locs_joined_bytes:
+        # Add mapping from source locator to the interface the packet was received on,
+        # and send any packets that were waiting for it
+        if loc_to_interface.learn(src_loc_bytes, received_interface):
+            _route_installed(src_loc_bytes)
+
+    # Only forward if the destination locator of the packet is different from
+    # the interface it was received on.
+    if received_interface_bytes == dst_loc_bytes:
+        return
+    interface = loc_to_interface.lookup(dst_loc_bytes)
+    if interface == None or message[codec.HOP_LIMIT_OFFSET] == 0:
+        return
+    # Decrement hop limit in place
+    message[codec.HOP_LIMIT_OFFSET] -= 1
+    link.send(interface, message)
+
+    global forwarded_count
+    forwarded_count += 1
+    if log_file != None and forward_log_sample > 0 and forwarded_count % forward_log_sample == 0:
+        (
+            masked_fields,
+            payload_length,
+            next_header,
+            hop_limit,
+            src_loc_bytes,
+            src_nid_bytes,
+            dst_loc_bytes,
+            dst_nid_bytes,
+        ) = codec.unpack(message)
         util.write_log(log_file, "%-45s <- %-30s %s %s" % (
-            ":".join([loc, nid]) + "%" + interface,
-            ":".join([local_loc, local_nid]),
+            ":".join([codec.bytes_to_hex(dst_loc_bytes), codec.bytes_to_hex(dst_nid_bytes)]) + "%" + interface,
+            "*" + ":".join([codec.bytes_to_hex(src_loc_bytes), codec.bytes_to_hex(src_nid_bytes)]) + "%" + received_interface,
             "(%5d, %2d, %2d)" % (payload_length, next_header, hop_limit),
-            (str(data[:29]) + "...") if len(data) > 32 else data
+            util.format_data(message[codec.HEADER_SIZE:], 32)
         ))
-    message = header + data
-    link.send(interface, message)
-    # Don't count discovery and locator update messages as active
-    if loc != ALL_NODES_LOC:
-        active_ilvs[(loc, nid)] = time.time()
-    # Return interface packet sent on
-    return interface
+    link.release(message)
 
 
-# receive now
-def _receive():
-    message, received_interface, from_ip = link.receive()
+# Process a packet received from the link layer.
+# message is a writable memoryview, which is sliced rather than copied.
+def _receive(message, received_interface, from_ip):
+    # Fast path for packets to be forwarded (not for us, and not discovery messages)
+    if codec.dst_nid(message) != local_nid_bytes and from_ip != link.local_addr:
+        dst_loc_bytes = codec.dst_loc(message)
+        if dst_loc_bytes != ALL_NODES_LOC_BYTES:
+            _forward(message, received_interface, dst_loc_bytes)
+            return
 
-    header = message[:40] # Header is 40 bytes
-    data = message[40:]
+    data = message[codec.HEADER_SIZE:]
 
     (
-        masked_bytes,
-        payload_length_bytes,
-        next_header_bytes,
-        hop_limit_bytes,
+        masked_fields,
+        payload_length,
+        next_header,
+        hop_limit,
         src_loc_bytes,
         src_nid_bytes,
         dst_loc_bytes,
         dst_nid_bytes,
-    ) = struct.unpack("!4s2sss8s8s8s8s", header)
-    
+    ) = codec.unpack(message)
+
     # Not currently used
-    # masked_fields = int.from_bytes(masked_bytes, byteorder="big", signed=False)
     # version       = (masked_fields & VERSION_MASK)       >> VERSION_SHIFT
     # traffic_class = (masked_fields & TRAFFIC_CLASS_MASK) >> TRAFFIC_CLASS_SHIFT
     # flow_label    = (masked_fields & FLOW_LABEL_MASK)    >> FLOW_LABEL_SHIFT
-    payload_length = util.bytes_to_int(payload_length_bytes)
-    next_header    = util.bytes_to_int(next_header_bytes)
-    hop_limit      = util.bytes_to_int(hop_limit_bytes)
-    src_loc        = util.bytes_to_hex(src_loc_bytes)
-    src_nid        = util.bytes_to_hex(src_nid_bytes)
-    dst_loc        = util.bytes_to_hex(dst_loc_bytes)
-    dst_nid        = util.bytes_to_hex(dst_nid_bytes)
+    src_loc = codec.bytes_to_hex(src_loc_bytes)
+    src_nid = codec.bytes_to_hex(src_nid_bytes)
+    dst_loc = codec.bytes_to_hex(dst_loc_bytes)
+    dst_nid = codec.bytes_to_hex(dst_nid_bytes)
 
     # Ignore own messages, if they aren't to us
     if from_ip == link.local_addr and dst_nid != local_nid:
@@ -161,42 +508,28 @@ def _receive():
             discovery.process_message(data, received_interface)
         return
     
+    # Joined ahead of a move, so learn routes and hosts there but don't process it further
+    if received_interface in prewarm_interfaces and dst_loc != received_interface:
+        _prewarm_receive(data, next_header, src_loc_bytes, src_nid_bytes, received_interface)
+        return
+
     # If for us, but received on a locator that we're not currently joined to, ignore.
     # This is required for not receiving duplicate messages during the soft handoff.
     if received_interface not in locs_joined and dst_loc != received_interface:
         return
     
-    if src_loc not in locs_joined:
-        # Add mapping from source locator to the interface the packet was received on
-        loc_to_interface[src_loc] = received_interface, time.time()
-
-    # If not for us, try to forward
-    if dst_nid != local_nid and dst_loc != ALL_NODES_LOC:
-        # Only forward if the destination locator of the packet is different from
-        # the interface it was received on.
-        if received_interface != dst_loc:
-            interface = map_locator_to_interface(dst_loc)
-            if interface != None:
-                mutable_message = bytearray(message)
-                if mutable_message[7] > 0:
-                    # Decrement hop limit
-                    mutable_message[7] -= 1
-                    hop_limit -= 1
-                    link.send(interface, bytes(mutable_message))
-                    util.write_log(log_file, "%-45s <- %-30s %s %s" % (
-                        ":".join([dst_loc, dst_nid]) + "%" + interface,
-                        "*" + ":".join([src_loc, src_nid]) + "%" + received_interface,
-                        "(%5d, %2d, %2d)" % (payload_length, next_header, hop_limit),
-                        (str(data[:29]) + "...") if len(data) > 32 else data
-                    ))
-        return
-    
+    if src_loc_bytes not in locs_joined_bytes:
+        # Add mapping from source locator to the interface the packet was received on,
+        # and send any packets that were waiting for it
+        if loc_to_interface.learn(src_loc_bytes, received_interface):
+            _route_installed(src_loc_bytes)
+
     if log_file != None:
         util.write_log(log_file, "%-45s -> %-30s %s %s" % (
             ":".join([src_loc, src_nid]) + "%" + received_interface,
             ":".join([dst_loc, dst_nid]),
             "(%5d,%3d,%3d)" % (payload_length, next_header, hop_limit),
-            (str(data[:29]) + "...") if len(data) > 32 else data
+            util.format_data(data, 32)
         ))
 
     if next_header == discovery.DISCOVERY_NEXT_HEADER:
@@ -204,218 +537,749 @@ def _receive():
         #  on interfaces we are leaving
         if received_interface not in locs_joined:
             return
-        solititation = discovery.process_message(data, received_interface)
-        # If discovery message was a solititation
-        if solititation:
-            # timestamp of last received solititation
-            global solititation_timestamp
-            solititation_timestamp = time.time()
-
-            # Respond to solititation
-            advertisement = discovery.get_advertisement(received_interface, local_nid)
-            # send advertisement to all interfaces
-            for loc in locs_joined:
-                send(
-                    ALL_NODES_LOC, "0:0:0:0", advertisement,
-                    discovery.DISCOVERY_NEXT_HEADER, map_locator_to_interface(loc)
-                )
+        # Ignore our own messages flooded back to us by routers,
+        # and copies of messages already processed and forwarded
+        if src_nid_bytes == local_nid_bytes or discovery.is_duplicate(data):
+            return
+        message_type = discovery.process_message(data, received_interface)
+        if message_type == discovery.SOLITITATION:
+            # Another node's solititation will refresh our host map too,
+            # so may suppress our own
+            solititation_trickle.hear_consistent()
 
-        # Forward discovery message to other interfaces
-        for loc in locs_joined:
-            if loc == received_interface:
-                continue
-            mutable_message = bytearray(message)
-            if mutable_message[7] > 0:
-                # Decrement hop limit
-                mutable_message[7] -= 1
-                link.send(map_locator_to_interface(loc), bytes(mutable_message))
+            # Respond to solititation, unless we advertised very recently,
+            # as an advertisement is flooded to every node, not just the solititor
+            global advertisement_timestamp
+            now = time.monotonic()
+            if now - advertisement_timestamp >= discovery.min_wait_time:
+                advertisement_timestamp = now
+                advertisement = discovery.get_advertisement(local_nid)
+                # send advertisement to all interfaces
+                for loc in locs_joined:
+                    send(
+                        ALL_NODES_LOC, "0:0:0:0", advertisement,
+                        discovery.DISCOVERY_NEXT_HEADER, map_locator_to_interface(loc)
+                    )
+
+        elif message_type == discovery.QUERY and discovery.query_target(data) == discovery.local_hst:
+            # Answer with an advertisement to the querier only,
+            # and don't flood the query any further as it has reached the node queried
+            advertisement = discovery.get_advertisement(local_nid)
+            send(
+                src_loc, src_nid, advertisement,
+                discovery.DISCOVERY_NEXT_HEADER, interface=received_interface
+            )
+            return
+
+        # Forward discovery message to other interfaces, unless it was unicast to us
+        if dst_loc_bytes == ALL_NODES_LOC_BYTES and message[7] > 0:
+            # Decrement hop limit in place
+            message[7] -= 1
+            link.send_batch([
+                (map_locator_to_interface(loc), message)
+                for loc in locs_joined if loc != received_interface
+            ])
         
     elif next_header == LOC_UPDATE_NEXT_HEADER:
-        advertisement = struct.unpack("!?", data[0:1])[0]
-        # If a locator update advertisement
-        if advertisement:
+        loc_update_type = data[0]
+        loc_update_ack = struct.pack("!B", LOC_UPDATE_ACK)
+        if loc_update_type == LOC_UPDATE:
             # Process locator updates
             # Start at 1 (after type field)
-            new_locs = [util.bytes_to_hex(struct.unpack("!8s", data[i:i+8])[0]) for i in range(1, len(data), 8)]
-            discovery.locator_update(src_loc, src_nid, new_locs)
+            new_locs = [codec.bytes_to_hex(bytes(data[i:i+8])) for i in range(1, len(data), 8)]
+            _apply_locator_update(src_loc, src_nid, new_locs)
             # Send locator update acknowledgement
-            loc_update_ack = struct.pack("!?", False)
             send(new_locs[0], src_nid, loc_update_ack, LOC_UPDATE_NEXT_HEADER, interface=received_interface)
-            active_ilvs[(new_locs[0], src_nid)] = time.time()
+        elif loc_update_type == SCHEDULED_LOC_UPDATE:
+            _, delay = SCHEDULED_LOC_UPDATE_HEADER.unpack_from(data)
+            offset = SCHEDULED_LOC_UPDATE_HEADER.size
+            new_locs = [codec.bytes_to_hex(bytes(data[i:i+8])) for i in range(offset, len(data), 8)]
+            _schedule(delay / 1000, _apply_locator_update, src_loc, src_nid, new_locs)
+            # Acknowledged from where it was sent, as the sender hasn't moved yet
+            send(src_loc, src_nid, loc_update_ack, LOC_UPDATE_NEXT_HEADER, interface=received_interface)
         # If a locator update acknowledgement
         else:
             ilv = (src_loc, src_nid)
-            if ilv in ilvs_to_update:
-                del ilvs_to_update[ilv]
-            if len(ilvs_to_update) == 0:
-                with loc_update_ack_cv:
-                    loc_update_ack_cv.notify()
-            active_ilvs[(src_loc, src_nid)] = time.time()
+            acked = loc_updates.ack(ilv) if loc_updates != None else None
+            if acked != None:
+                retransmissions, rtt = acked
+                # Round trip times are only measured for locator updates not retransmitted,
+                # as acknowledgements can't be matched to a send (Karn's algorithm)
+                if retransmissions == 0:
+                    discovery.record_rtt(src_loc, rtt)
+                    interface_stats.rtt_sample(received_interface, rtt)
+                discovery.record_loss(src_loc, False)
+                if log_file != None:
+                    util.write_log(log_file, "Locator update to %s acknowledged after %.3fs, %d retransmissions" % (
+                        ":".join(ilv), loc_updates.completion_times[ilv], retransmissions
+                    ))
+            active_ilvs.touch(ilv)
     
     else:
-        active_ilvs[(src_loc, src_nid)] = time.time()
+        active_ilvs.touch((src_loc, src_nid))
+        handler = handlers.get(next_header)
+        if handler != None:
+            handler(data, src_loc, src_nid, dst_loc, dst_nid, received_interface)
+            return
         return (next_header, (data, src_loc, src_nid, dst_loc, dst_nid, received_interface))
 
 
-# Receive from queue
+# Apply a locator update from (loc, nid), which has moved to new_locs
+def _apply_locator_update(loc, nid, new_locs):
+    discovery.locator_update(loc, nid, new_locs)
+    flow_routes.clear()
+    # Keep sending to the locator being left too, until its soft handoff is likely over
+    if bicast and loc not in new_locs:
+        bicast_locs[nid] = (loc, time.monotonic() + bicast_time)
+    active_ilvs.touch((new_locs[0], nid))
+
+
+# Call callback(*args) in delay seconds, on the event loop with the asyncio runtime
+def _schedule(delay, callback, *args):
+    if runtime == "asyncio":
+        loop.call_soon_threadsafe(loop.call_later, delay, callback, *args)
+    else:
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+
+
+# Learn from a packet received on a locator joined ahead of a move.
+# Routes learnt don't replace current ones until the move, and discovery messages
+# are processed but not answered or forwarded.
+def _prewarm_receive(data, next_header, src_loc_bytes, src_nid_bytes, received_interface):
+    if src_loc_bytes not in locs_joined_bytes:
+        loc_to_interface.add_provisional(src_loc_bytes, received_interface, backwards_learning_ttl)
+        prewarm_routes[src_loc_bytes] = received_interface
+        _route_installed(src_loc_bytes)
+    if next_header == discovery.DISCOVERY_NEXT_HEADER:
+        if src_nid_bytes != local_nid_bytes and not discovery.is_prewarm_duplicate(data):
+            discovery.process_message(data, received_interface)
+
+
+# Register handler to be called with (data, src_loc, src_nid, dst_loc, dst_nid, interface)
+# for each packet received with next_header, instead of queueing it for receive.
+# It's called on the thread receiving from the link (or event loop, with the asyncio runtime),
+# so shouldn't block.
+def register_handler(next_header, handler):
+    handlers[next_header] = handler
+    # Packets queued before there was a handler would otherwise never be received
+    in_queues.pop(next_header, None)
+
+
+# Register handler to be called every forwarding table tick, e.g. to forget flows
+# that are idle (see is_idle). It's called on the expiry thread (or event loop,
+# with the asyncio runtime), so shouldn't block.
+def register_expiry(handler):
+    expiry_handlers.append(handler)
+
+
+# If a flow last active at tick (of the forwarding table) has been idle
+# for longer than active_uncast_session_ttl, so can be forgotten
+def is_idle(tick):
+    return (loc_to_interface.tick - tick) * loc_to_interface.tick_time > active_uncast_session_ttl
+
+
+# Receive from queue, for next headers without a handler
 def receive(next_header):
     # Raises IndexError if no elements present, or KeyError if no queue exists
     return in_queues[next_header].popleft()
 
 
-# receives messages and adds them to receive queue
+# Returns {next header: (queued, high water mark, dropped)} of in_queues
+def queue_stats():
+    return {
+        next_header: (len(in_queue), in_queue.high_water, in_queue.dropped)
+        for next_header, in_queue in list(in_queues.items())
+    }
+
+
+# Process a batch of packets received from the link layer,
+# returning the next headers of those added to in_queues
+def _receive_batch(batch):
+    queued = set()
+    for message, received_interface, from_ip in batch:
+        try:
+            returned = _receive(message, received_interface, from_ip)
+            if returned != None:
+                next_header, returned_tuple = returned
+                in_queue = in_queues.get(next_header)
+                if in_queue == None:
+                    in_queue = in_queues.setdefault(
+                        next_header, util.PacketQueue(queue_capacity, queue_policy)
+                    )
+                if in_queue.put(returned_tuple):
+                    util.log_queue_drop(log_file, "Next header %d queue" % next_header, in_queue)
+                queued.add(next_header)
+        except Exception as e:
+            if log_file != None:
+                util.write_log(log_file, "Error receiving: %s" % e)
+    return queued
+
+
+# Let receivers know packets were added to in_queues, once per batch
+def _notify_receivers(queued):
+    for next_header in queued:
+        with receive_cvs[next_header]:
+            receive_cvs[next_header].notify()
+
+
+# Called by the asyncio runtime's event loop when a link socket is readable
+def _receive_ready(interface):
+    try:
+        batch = link.receive_ready(interface)
+    except Exception as e:
+        if log_file != None:
+            util.write_log(log_file, "Error receiving: %s" % e)
+        return
+    _notify_receivers(_receive_batch(batch))
+
+
+# Join locator, receiving from it separately if the link has a socket per locator
+def _join(loc):
+    link.join(loc)
+    if link.sharded:
+        if runtime == "asyncio":
+            loop.add_reader(link.receive_socket(loc), _receive_ready, loc)
+        else:
+            ReceiveThread(loc).start()
+
+
+def _leave(loc):
+    if link.sharded and runtime == "asyncio":
+        loop.remove_reader(link.receive_socket(loc))
+    link.leave(loc)
+
+
+# receives messages and adds them to receive queue.
+# If the link has a socket per locator there is one thread per joined locator
+# (interface), which exits when the locator is left. Packets from an ILV
+# arrive on one locator so are still queued in order, but packets arriving
+# on different locators (e.g. from a peer during its soft handoff) may be
+# queued in a different order than they were received.
+# The threads only wait on their sockets concurrently, as processing holds the GIL.
 class ReceiveThread(threading.Thread):
+    def __init__(self, interface=None):
+        threading.Thread.__init__(self)
+        self.interface = interface
+
     def run(self):
-        # cv = conditional value
-        global receive_cvs
-        receive_cvs = defaultdict(threading.Condition)
         # Queues by next header
         while True:
             try:
-                returned = _receive()
-                if returned != None:
-                    next_header, returned_tuple = returned
-                    in_queues.setdefault(
-                        next_header, collections.deque(maxlen=None)
-                    ).append((
-                        returned_tuple
-                    ))
-                    with receive_cvs[next_header]:
-                        receive_cvs[next_header].notify()
+                batch = link.receive_batch(self.interface)
+            except EOFError:
+                # Interface left
+                return
             except Exception as e:
                 if log_file != None:
                     util.write_log(log_file, "Error receiving: %s" % e)
+                continue
+            _notify_receivers(_receive_batch(batch))
+
+
+# Expires forwarding table and discovery mappings every tick
+class ExpiryThread(threading.Thread):
+    def run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += loc_to_interface.tick_time
+            remaining = next_tick - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            _expire()
+
+
+def _expire():
+    try:
+        loc_to_interface.advance()
+        discovery.expire()
+        _expire_pending()
+        _expire_flows()
+        for handler in expiry_handlers:
+            handler()
+    except Exception as e:
+        if log_file != None:
+            util.write_log(log_file, "Error expiring mappings: %s" % e)
+
+    global next_snapshot_time
+    if snapshot_file != None and time.monotonic() >= next_snapshot_time:
+        next_snapshot_time += snapshot_interval
+        _save_snapshot()
+
+
+# Forget the cached routes of idle flows, so they don't accumulate and their labels can be reused
+def _expire_flows():
+    for flow_label, route in list(flow_routes.items()):
+        if is_idle(route[5]):
+            # Unless it was replaced by a send since
+            if flow_routes.get(flow_label) is route:
+                flow_routes.pop(flow_label, None)
+
+
+# Saves learnt forwarding and discovery mappings to snapshot_file
+def _save_snapshot():
+    try:
+        forwarding = [
+            (loc, codec.hex_to_bytes(interface), remaining)
+            for loc, interface, remaining in loc_to_interface.learnt()
+        ]
+        snapshot.write(snapshot_file, forwarding, discovery.snapshot_entries())
+    except Exception as e:
+        if log_file != None:
+            util.write_log(log_file, "Error saving snapshot: %s" % e)
+
+
+# Loads mappings saved by a previous run from snapshot_file.
+# They're provisional, expiring within discovery.wait_time unless learnt again,
+# as any still valid will be by then.
+def _load_snapshot():
+    try:
+        forwarding, hosts = snapshot.read(snapshot_file)
+    except Exception as e:
+        if log_file != None:
+            util.write_log(log_file, "Error loading snapshot: %s" % e)
+        return
+    for loc, interface_bytes, remaining in forwarding:
+        interface = codec.bytes_to_hex(interface_bytes)
+        # Only to interfaces we've joined again
+        if interface in locs_joined and loc not in locs_joined_bytes:
+            loc_to_interface.add_provisional(loc, interface, min(remaining, discovery.wait_time))
+            _route_installed(loc)
+    discovery.load_snapshot_entries(hosts, discovery.wait_time)
+    if log_file != None:
+        util.write_log(log_file, "Loaded snapshot %s: %d forwarding, %d host mappings" % (
+            snapshot_file, len(forwarding), len(hosts)
+        ))
+
+
+# Saves state to be restored on restart, to be called before exiting
+def shutdown():
+    if snapshot_file != None:
+        _save_snapshot()
+
+
+def _terminate(signum, frame):
+    shutdown()
+    os._exit(128 + signum)
+
+
+# Sends solititations on every joined locator when solititation_trickle says to.
+# Returns the time to wait before calling again.
+def _solicit():
+    transmit, wait = solititation_trickle.poll()
+    if transmit:
+        _send_solititation()
+    return wait
+
+
+# Sends a solititation on every joined locator
+def _send_solititation():
+    try:
+        # One solititation for all locators, so nodes receiving it on more than one
+        # recognise the copies
+        solititation = discovery.get_solititation(local_nid)
+        for loc in locs_joined:
+            # nid doesn't matter for ALL_NODES_LOC
+            send(
+                ALL_NODES_LOC, "0:0:0:0", solititation,
+                discovery.DISCOVERY_NEXT_HEADER, loc
+            )
+    except Exception as e:
+        if log_file != None:
+            util.write_log(log_file, "Error sending solicitation: %s" % e)
+
+
+# Queries for hostname on every joined locator, for discovery's "query" resolution
+def _query(hostname):
+    try:
+        query = discovery.get_query(local_nid, hostname)
+        for loc in locs_joined:
+            send(
+                ALL_NODES_LOC, "0:0:0:0", query,
+                discovery.DISCOVERY_NEXT_HEADER, loc
+            )
+    except Exception as e:
+        if log_file != None:
+            util.write_log(log_file, "Error sending query: %s" % e)
 
 
 class SolititationThread(threading.Thread):
     def run(self):
+        # Set when solititation_trickle is reset, to solicit sooner
+        wake = threading.Event()
+        solititation_trickle.wake = wake.set
         while True:
-            try:
-                global solititation_timestamp
-                # don't send solititation if solititation received in passed discovery.wait_time
-                if solititation_timestamp == 0 or time.time() - solititation_timestamp > discovery.wait_time:
-                    for loc in locs_joined:
-                        # nid doesn't matter for ALL_NODES_LOC
-                        send(
-                            ALL_NODES_LOC, "0:0:0:0", discovery.get_solititation(loc, local_nid),
-                            discovery.DISCOVERY_NEXT_HEADER, loc
-                        )
-                    solititation_timestamp = time.time()
-                # sleep a random time from (discovery.wait_time / 2) to discovery.wait_time
-                time.sleep(random.random() * discovery.wait_time / 2 + discovery.wait_time / 2)
-            except Exception as e:
-                if log_file != None:
-                    util.write_log(log_file, "Error sending solicitation: %s" % e)
+            wake.clear()
+            wake.wait(_solicit())
 
 
-class MoveThread(threading.Thread):
-    def __init__(self, loc_cycle, move_time, handoff_time, loc_update_retries, loc_update_retry_wait_time):
-        threading.Thread.__init__(self)
-        self.loc_cycle = loc_cycle
-        self.move_time = move_time
+# Handoff policies, see handoff: "cycle" moves through loc_cycle every move_time,
+# and "hysteresis" to the locators in loc_cycle with the best measured paths
+HANDOFF_POLICIES = ("cycle", "hysteresis")
+
+
+# Moves between sets of locators when policy decides to (see handoff),
+# with a soft handoff during which both old and new locators are joined.
+# If prewarm_time is set, and the policy knows its next move in advance, the next locators
+# are joined that long before each move, so routes and hosts there are learnt,
+# and locator updates taking effect at the move are sent, before it happens (make before break).
+# Driven by MoveThread, or by _move_coroutine in the asyncio runtime.
+class Mover:
+    # Steps returned by poll
+    PREWARM = "prewarm"
+    MOVE = "move"
+
+    def __init__(self, policy, handoff_time, loc_update_retry_wait_time, prewarm_time=0):
+        self.policy = policy
         self.handoff_time = handoff_time
-        self.loc_cycle_index = 0
-        self.loc_update_retries = loc_update_retries
+        self.prewarm_time = prewarm_time
         self.loc_update_retry_wait_time = loc_update_retry_wait_time
+        # Locators to prewarm or move to
+        self.target = None
+        # Map of ILVs being sent the current locator update to the interface to send it on
+        self.update_interfaces = {}
+        # Locators joined by prewarm for the next move
+        self.prewarmed_locs = []
+        # When (time.time) the next move happens, if its locator updates are sent before it
+        self.activation_time = None
+
+    # Returns (step, wait), where step is PREWARM or MOVE if that should be done now,
+    # otherwise None, and wait is the time until poll should next be called
+    def poll(self):
+        target, wait = self.policy.poll(locs_joined)
+        if target != None:
+            self.target = target
+            return self.MOVE, 0
+        if self.prewarm_time > 0 and self.activation_time == None:
+            prediction = self.policy.predict(locs_joined)
+            if prediction != None:
+                target, move_time = prediction
+                lead_time = move_time - time.time()
+                if lead_time <= self.prewarm_time:
+                    self.target = target
+                    self.activation_time = move_time
+                    return self.PREWARM, 0
+                wait = min(wait, lead_time - self.prewarm_time)
+        return None, wait
+
+    # Joins the locators about to be moved to ahead of the move, and sends
+    # locator updates taking effect when the move will happen, at activation_time
+    def prewarm(self):
+        next_locs = self.target
+        self.prewarmed_locs = [loc for loc in next_locs if loc not in locs_joined]
+        if log_file != None:
+            util.write_log(log_file, "Prewarming %s" % self.prewarmed_locs)
+
+        global prewarm_interfaces
+        for loc in self.prewarmed_locs:
+            _join(loc)
+            loc_to_interface.add_static(codec.hex_to_bytes(loc), loc)
+            _route_installed(codec.hex_to_bytes(loc))
+        prewarm_interfaces = frozenset(self.prewarmed_locs)
+
+        # Solicit on the next locators, so their hosts advertise and routes to them are learnt,
+        # and routers there learn routes to the next locators
+        if len(self.prewarmed_locs) > 0:
+            solititation = discovery.get_solititation(local_nid)
+            for loc in self.prewarmed_locs:
+                send(ALL_NODES_LOC, "0:0:0:0", solititation, discovery.DISCOVERY_NEXT_HEADER, loc)
+
+        self._start_loc_updates(next_locs, {}, self.activation_time)
+
+    # Joins the locators the policy decided to move to, and sends locator updates to active ilvs
+    def start_move(self):
+        self.old_locs_joined = locs_joined
+        self.new_locs_joined = self.target
+        old_locs_joined = self.old_locs_joined
+        new_locs_joined = self.new_locs_joined
+
+        if log_file != None:
+            util.write_log(log_file, "Moving from %s to %s" % (old_locs_joined, new_locs_joined))
+
+        # ILVs that acknowledged the locator update scheduled by prewarm have already switched
+        if self.activation_time != None:
+            updated = {
+                ilv: completion_time for ilv, completion_time in loc_updates.completion_times.items()
+                if completion_time != None
+            }
+        else:
+            updated = {}
+        self.activation_time = None
+
+        # Update locs_joined for discovery protocol forwarding
+        _set_locs_joined(new_locs_joined)
+
+        self._start_loc_updates(new_locs_joined, updated, time.time() + self.handoff_time)
+
+        # Join multicast groups corresponding to new locators (unless prewarm already has),
+        # add new locators to fowarding table,
+        # and send a discovey protocol advertisment on new locators for path discovery through backwards learning.
+        # The advertisement is of the change to our locators, which other nodes apply atomically.
+        joined = [loc for loc in new_locs_joined if loc not in old_locs_joined]
+        for loc in joined:
+            if loc not in self.prewarmed_locs:
+                _join(loc)
+            loc_to_interface.add_static(codec.hex_to_bytes(loc), loc)
+            _route_installed(codec.hex_to_bytes(loc))
+        # In case the policy moved somewhere other than predicted
+        for loc in self.prewarmed_locs:
+            if loc not in new_locs_joined:
+                loc_to_interface.purge_interface(loc)
+                _leave(loc)
+        # Switch to routes learnt through the new locators while prewarming
+        global prewarm_interfaces
+        prewarm_interfaces = frozenset()
+        self.prewarmed_locs = []
+        for loc_bytes, interface in list(prewarm_routes.items()):
+            loc_to_interface.learn(loc_bytes, interface)
+            _route_installed(loc_bytes)
+        prewarm_routes.clear()
+        flow_routes.clear()
+        leaving = [loc for loc in old_locs_joined if loc not in new_locs_joined]
+        if bicast and len(joined) > 0 and len(leaving) > 0:
+            global handoff_interfaces
+            handoff_interfaces = (tuple(leaving), tuple(joined))
+        if len(joined) > 0:
+            # Solicit soon on the new locators to learn their hosts
+            solititation_trickle.reset()
+            advertisement = discovery.get_advertisement(local_nid, delta=True)
+            for loc in joined:
+                send(
+                    ALL_NODES_LOC, "0:0:0:0", advertisement,
+                    discovery.DISCOVERY_NEXT_HEADER, loc
+                )
+
+        self.handoff_start_time = time.time()
+
+    # Starts sending locator updates to new_locs to active ilvs, other than those in updated,
+    # until deadline (time.time). updated maps ilvs that have already acknowledged them
+    # to their completion times, which are kept for handoff_stats.
+    def _start_loc_updates(self, new_locs, updated, deadline):
+        self.loc_update_locs = b"".join(codec.hex_to_bytes(loc) for loc in new_locs)
+        self.loc_update_deadline = deadline
+        # Store interface mappings of active_ilvs to avoid
+        # sending locator updates on new locators (or else the remote node can't identify us).
+        # Each ILV's first retransmission timeout is derived from its locator's round trip time,
+        # if it's been measured.
+        self.update_interfaces = {}
+        timeouts = {}
+        for ilv in active_ilvs.active(active_uncast_session_ttl):
+            if ilv in updated:
+                continue
+            dst_loc, dst_nid = ilv
+            self.update_interfaces[ilv] = map_locator_to_interface(dst_loc)
+            rto = discovery.locator_stats.rto(dst_loc)
+            if rto == None:
+                timeouts[ilv] = self.loc_update_retry_wait_time
+            else:
+                timeouts[ilv] = max(rto, MIN_LOC_UPDATE_TIMEOUT)
+        loc_updates.start(timeouts, updated)
+
+    # Sends the locator update to active ilvs that are due it, i.e. haven't acknowledged it
+    # and haven't been sent it in their timeout. Returns the time to wait before calling again,
+    # or None once every ilv has acknowledged or been given up on.
+    def send_loc_updates(self):
+        # Not worth retransmitting once the old locators are left, or the move has happened
+        remaining_time = self.loc_update_deadline - time.time()
+        if remaining_time <= 0:
+            for ilv in loc_updates.cancel():
+                self._log_given_up(ilv)
+        if self.activation_time != None:
+            # Taking effect at the move
+            delay = max(0, round((self.activation_time - time.time()) * 1000))
+            loc_update = SCHEDULED_LOC_UPDATE_HEADER.pack(SCHEDULED_LOC_UPDATE, delay) + self.loc_update_locs
+        else:
+            loc_update = struct.pack("!B", LOC_UPDATE) + self.loc_update_locs
+        due, wait = loc_updates.poll()
+        for ilv, retransmissions in due:
+            dst_loc, dst_nid = ilv
+            if retransmissions > 0:
+                # Not acknowledged in time, so taken to be lost
+                discovery.record_loss(dst_loc, True)
+            send(dst_loc, dst_nid, loc_update, LOC_UPDATE_NEXT_HEADER, interface=self.update_interfaces[ilv])
+        for ilv, completion_time in list(loc_updates.completion_times.items()):
+            if completion_time == None and ilv in self.update_interfaces:
+                self._log_given_up(ilv)
+        if loc_updates.done():
+            return None
+        return min(wait, max(0, remaining_time))
+
+    def _log_given_up(self, ilv):
+        # Only logged once
+        if self.update_interfaces.pop(ilv, None) != None and log_file != None:
+            util.write_log(log_file, "Locator update to %s not acknowledged" % ":".join(ilv))
+
+    # Time left of the soft handoff
+    def remaining_handoff_time(self):
+        return self.handoff_time + self.handoff_start_time - time.time()
+
+    # Leaves old locators, removing mappings to them from the forwarding table
+    def finish_move(self):
+        global handoff_interfaces
+        handoff_interfaces = None
+        for loc in self.old_locs_joined:
+            if loc not in self.new_locs_joined:
+                loc_to_interface.purge_interface(loc)
+                _leave(loc)
+        flow_routes.clear()
+
+
+class MoveThread(threading.Thread):
+    def __init__(self, mover):
+        threading.Thread.__init__(self)
+        self.mover = mover
 
     def run(self):
-        global loc_update_ack_cv
-        loc_update_ack_cv = threading.Condition()
-        time.sleep(self.handoff_time)
+        mover = self.mover
+        # Set when every ILV has acknowledged the locator update
+        self.wake = threading.Event()
+        loc_updates.wake = self.wake.set
         while True:
-            time.sleep(self.move_time - self.handoff_time)
             try:
-                global locs_joined
-                global loc_to_interface
-                old_locs_joined = locs_joined
-                self.loc_cycle_index = (self.loc_cycle_index + 1) % len(self.loc_cycle)
-                new_locs_joined = self.loc_cycle[self.loc_cycle_index]
+                step, wait = mover.poll()
+                if step == None:
+                    time.sleep(wait)
+                    continue
 
-                if log_file != None:
-                    util.write_log(log_file, "Moving from %s to %s" % (old_locs_joined, new_locs_joined))
-
-                # Update locs_joined for discovery protocol forwarding
-                locs_joined = new_locs_joined
-
-                # Store interface mappings of active_ilvs to avoid
-                # sending locator updates on new locators (or else the remote node can't identify us).
-                global ilvs_to_update
-                ilvs_to_update = {}
-                old_active_ilvs = []
-                for ilv, timestamp in active_ilvs.items():
-                    if time.time() - timestamp > active_uncast_session_ttl:
-                        old_active_ilvs.add(ilv)
-                        continue
-                    dst_loc, dst_nid = ilv
-                    ilvs_to_update[ilv] = map_locator_to_interface(dst_loc)
-                for ilv in old_active_ilvs:
-                    del active_ilvs[ilv]
-
-                # Join multicast groups corresponding to new locators,
-                # add new locators to fowarding table,
-                # and send a discovey protocol advertisment on new locators for path discovery through backwards learning
-                for loc in new_locs_joined:
-                    if loc not in old_locs_joined:
-                        link.join(loc)
-                        loc_to_interface[loc] = loc, None
-                        advertisement = discovery.get_advertisement(loc, local_nid)
-                        send(
-                            ALL_NODES_LOC, "0:0:0:0", advertisement,
-                            discovery.DISCOVERY_NEXT_HEADER, loc
-                        )
-                
-                # Send locator update advertisement to active ilvs
-                new_locs_joined_bytes = [util.hex_to_bytes(joined_loc, 8) for joined_loc in new_locs_joined]
-                loc_update_advrt = struct.pack("!?" + "8s" * len(new_locs_joined), True, *new_locs_joined_bytes)
-                
-                for ilv, interface in ilvs_to_update.items():
-                    dst_loc, dst_nid = ilv
-                    send(dst_loc, dst_nid, loc_update_advrt, LOC_UPDATE_NEXT_HEADER, interface=interface)
-                
-                # Wait for locator update advertisements, retrying advertisement if required,
-                intial_handoff_time = time.time()
-                for i in range(self.loc_update_retries):
-                    with loc_update_ack_cv:
-                        loc_update_ack_cv.wait(self.loc_update_retry_wait_time)
-                    # Retry locator update advertisement
-                    for ilv, interface in ilvs_to_update.items():
-                        dst_loc, dst_nid = ilv
-                        send(dst_loc, dst_nid, loc_update_advrt, LOC_UPDATE_NEXT_HEADER, interface=interface)
+                if step == Mover.PREWARM:
+                    mover.prewarm()
+                    self.send_loc_updates()
+                    continue
+
+                mover.start_move()
+                self.send_loc_updates()
 
                 # Wait for soft handoff
-                remaining_handoff_time = self.handoff_time + intial_handoff_time - time.time()
+                remaining_handoff_time = mover.remaining_handoff_time()
                 if remaining_handoff_time > 0:
                     time.sleep(remaining_handoff_time)
 
-                # Reset forwarding table
-                to_remove=[]
-                for mapped_loc, (interface, timestamp) in loc_to_interface.items():
-                    if interface not in new_locs_joined:
-                        to_remove.append(mapped_loc)
-                for mapped_loc in to_remove:
-                    del loc_to_interface[mapped_loc]
-                
-                # Finally, leave old locators
-                for loc in old_locs_joined:
-                    if loc not in new_locs_joined:
-                        link.leave(loc)
-                
+                mover.finish_move()
+
             except Exception as e:
                 if log_file != None:
                     util.write_log(log_file, "Error moving: %s" % e)
 
+    # Send locator updates, retransmitting to each ILV until it acknowledges
+    def send_loc_updates(self):
+        while True:
+            self.wake.clear()
+            wait = self.mover.send_loc_updates()
+            if wait == None:
+                break
+            self.wake.wait(wait)
+
+
+# Tasks of the asyncio runtime, which are scheduled on loop rather than run in threads
+
+async def _expire_coroutine():
+    next_tick = time.monotonic()
+    while True:
+        next_tick += loc_to_interface.tick_time
+        await asyncio.sleep(next_tick - time.monotonic())
+        _expire()
+
+
+async def _solicit_coroutine():
+    # Set when solititation_trickle is reset, which may be from another thread
+    wake = asyncio.Event()
+    solititation_trickle.wake = lambda: loop.call_soon_threadsafe(wake.set)
+    while True:
+        wake.clear()
+        try:
+            await asyncio.wait_for(wake.wait(), _solicit())
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _move_coroutine(mover):
+    # Set when every ILV has acknowledged the locator update, which may be from another thread
+    wake = asyncio.Event()
+    loc_updates.wake = lambda: loop.call_soon_threadsafe(wake.set)
+
+    # Send locator updates, retransmitting to each ILV until it acknowledges
+    async def send_loc_updates():
+        while True:
+            wake.clear()
+            wait = mover.send_loc_updates()
+            if wait == None:
+                break
+            try:
+                await asyncio.wait_for(wake.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    while True:
+        try:
+            step, wait = mover.poll()
+            if step == None:
+                await asyncio.sleep(wait)
+                continue
+
+            if step == Mover.PREWARM:
+                mover.prewarm()
+                await send_loc_updates()
+                continue
+
+            mover.start_move()
+            await send_loc_updates()
+
+            # Wait for soft handoff
+            remaining_handoff_time = mover.remaining_handoff_time()
+            if remaining_handoff_time > 0:
+                await asyncio.sleep(remaining_handoff_time)
+
+            mover.finish_move()
+
+        except Exception as e:
+            if log_file != None:
+                util.write_log(log_file, "Error moving: %s" % e)
+
+
+# Runs the asyncio runtime's event loop
+class LoopThread(threading.Thread):
+    def run(self):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
 
 def startup():
     config_section = util.config["network"]
+
+    # Runtime the network stack, and transport, run on:
+    #  "threads" for threads receiving, soliciting, and moving, or
+    #  "asyncio" for callbacks and coroutines on one event loop, run by LoopThread
+    global runtime
+    if "runtime" in config_section:
+        runtime = config_section["runtime"]
+    else:
+        runtime = "threads"
+    if runtime not in ("threads", "asyncio"):
+        raise NetworkException("Unknown runtime '%s'" % runtime)
     
-    global locs_joined
+    # Time that locator to interface mappings learnt by backwards learning will be valid
+    global backwards_learning_ttl
+    if "backwards_learning_ttl" in config_section:
+        backwards_learning_ttl = config_section.getfloat("backwards_learning_ttl")
+    else:
+        backwards_learning_ttl = 30
+
+    # Granularity in seconds of forwarding table expiry
+    if "forwarding_tick" in config_section:
+        forwarding_tick = config_section.getfloat("forwarding_tick")
+    else:
+        forwarding_tick = 1
+
+    global loc_to_interface
+    loc_to_interface = tables.ForwardingTable(backwards_learning_ttl, forwarding_tick)
+
     loc_cycle = [[loc.strip() for loc in cycle.split(",")] for cycle in config_section["locators"].split("-")]
-    locs_joined = loc_cycle[0]
+    _set_locs_joined(loc_cycle[0])
     for loc in locs_joined:
         link.join(loc)
-        # For locs joined, send to own interface
-        # Timestamp of None indicates that this is a non-expiring mapping
-        loc_to_interface[loc] = loc, None
+        # For locs joined, send to own interface, with a non-expiring mapping
+        loc_to_interface.add_static(codec.hex_to_bytes(loc), loc)
 
     global local_nid
     if "nid" in config_section:
@@ -424,38 +1288,117 @@ def startup():
         # TODO improve assignement
         local_nid = util.bytes_to_hex(secrets.token_bytes(8))
     # TODO add collision detection
+    global local_nid_bytes
+    local_nid_bytes = codec.hex_to_bytes(local_nid)
 
     global default_hop_limit
     if "default_hop_limit" in config_section:
-        default_hop_limit = config_section["default_hop_limit"]
+        default_hop_limit = config_section.getint("default_hop_limit")
     else:
         default_hop_limit = 3
-    
-    # Time that locator to interface mappings learnt by backwards learning will be valid
-    global backwards_learning_ttl
-    if "backwards_learning_ttl" in config_section:
-        backwards_learning_ttl = config_section["backwards_learning_ttl"]
-    else:
-        backwards_learning_ttl = 30
-    
+
     global active_uncast_session_ttl
     if "active_uncast_session_ttl" in config_section:
-        active_uncast_session_ttl = config_section["active_uncast_session_ttl"]
+        active_uncast_session_ttl = config_section.getfloat("active_uncast_session_ttl")
     else:
         active_uncast_session_ttl = 30
 
+    # Log every forward_log_sample'th forwarded packet, or none if 0
+    global forward_log_sample
+    if "forward_log_sample" in config_section:
+        forward_log_sample = config_section.getint("forward_log_sample")
+    else:
+        forward_log_sample = 0
+
+    # Capacity and drop policy of in_queues, see util.PacketQueue
+    global queue_capacity, queue_policy
+    queue_capacity, queue_policy = util.get_queue_config("network")
+    if queue_policy == "block" and runtime == "asyncio":
+        raise NetworkException("Queue policy 'block' would block the asyncio runtime's event loop")
+
     global log_file
     log_file = util.get_log_file("network")
-    
-    ReceiveThread().start()
 
-    # Discovery startup should run after link startup
+    # Discovery startup should run after link startup, and before receiving
     discovery.startup()
 
-    global solititation_timestamp
-    solititation_timestamp = 0
-    # Start thread to send solititation messages from discovery module
-    SolititationThread().start()
+    # If to bicast during soft handoffs, both ours and those of nodes we send to,
+    # sending packets on both the old and new paths. The transport drops the duplicates.
+    global bicast, bicast_time
+    if "bicast" in config_section:
+        bicast = config_section.getboolean("bicast")
+    else:
+        bicast = False
+    # Time in seconds to keep bicasting to a node's old locator after its locator update
+    if "bicast_time" in config_section:
+        bicast_time = config_section.getfloat("bicast_time")
+    else:
+        bicast_time = 10
+
+    # Maximum packets waiting for an interface to each locator, or 0 to raise
+    # a NetworkException when sending to a locator with no interface
+    global pending_capacity
+    if "pending_capacity" in config_section:
+        pending_capacity = config_section.getint("pending_capacity")
+    else:
+        pending_capacity = 8
+
+    # Time in seconds packets wait for an interface to their locator before being dropped
+    global pending_timeout
+    if "pending_timeout" in config_section:
+        pending_timeout = config_section.getfloat("pending_timeout")
+    else:
+        pending_timeout = 2
+
+    # File learnt mappings are saved to every snapshot_interval seconds and on shutdown,
+    # and loaded from on startup, or None to not save them
+    global snapshot_file, snapshot_interval, next_snapshot_time
+    if "snapshot_file" in config_section:
+        snapshot_file = config_section["snapshot_file"]
+    else:
+        snapshot_file = None
+    if "snapshot_interval" in config_section:
+        snapshot_interval = config_section.getfloat("snapshot_interval")
+    else:
+        snapshot_interval = 10
+    next_snapshot_time = time.monotonic() + snapshot_interval
+    if snapshot_file != None:
+        _load_snapshot()
+        # Save on being killed too
+        signal.signal(signal.SIGTERM, _terminate)
+
+    # Schedules solititations, see trickle.Trickle.
+    # The host map is inconsistent when a lookup in it misses.
+    global solititation_trickle
+    solititation_trickle = trickle.Trickle(
+        discovery.min_wait_time, discovery.wait_time, discovery.redundancy
+    )
+    discovery.miss_callback = solititation_trickle.reset
+    discovery.queue_length_callback = _queue_length
+    discovery.query_callback = _query
+
+    if runtime == "asyncio":
+        global loop
+        loop = asyncio.new_event_loop()
+        # Receive from each locator's socket if the link has a socket per locator
+        for interface in (locs_joined if link.sharded else [None]):
+            loop.add_reader(link.receive_socket(interface), _receive_ready, interface)
+        loop.create_task(_expire_coroutine())
+    else:
+        if link.sharded:
+            for loc in locs_joined:
+                ReceiveThread(loc).start()
+        else:
+            ReceiveThread().start()
+        ExpiryThread().start()
+
+    # Start sending solititation messages from discovery module,
+    # unless hostnames are only resolved by querying for them
+    if discovery.resolution == "flood":
+        if runtime == "asyncio":
+            loop.create_task(_solicit_coroutine())
+        else:
+            SolititationThread().start()
 
     if len(loc_cycle) > 1:
 
@@ -464,22 +1407,66 @@ def startup():
         else:
             move_time = 20
 
+        # When to move, and where to, see HANDOFF_POLICIES
+        if "handoff_policy" in config_section:
+            handoff_policy = config_section["handoff_policy"]
+        else:
+            handoff_policy = "cycle"
+        if handoff_policy not in HANDOFF_POLICIES:
+            raise NetworkException("Unknown handoff policy '%s'" % handoff_policy)
+
+        # For the hysteresis policy, the fraction of the current locators' cost
+        # others must be cheaper by, for handoff_hold_time seconds, to be moved to
+        if "handoff_margin" in config_section:
+            handoff_margin = config_section.getfloat("handoff_margin")
+        else:
+            handoff_margin = 0.2
+        if "handoff_hold_time" in config_section:
+            handoff_hold_time = config_section.getfloat("handoff_hold_time")
+        else:
+            handoff_hold_time = 2
+
         if "handoff_time" in config_section:
             handoff_time = config_section.getfloat("handoff_time")
         else:
             handoff_time = 10
 
         if "loc_update_retries" in config_section:
-            loc_update_retries = config_section["loc_update_retries"]
+            loc_update_retries = config_section.getint("loc_update_retries")
         else:
             loc_update_retries = 3
         
         if "loc_update_retry_wait_time" in config_section:
-            loc_update_retry_wait_time = config_section["loc_update_retry_wait_time"]
+            loc_update_retry_wait_time = config_section.getfloat("loc_update_retry_wait_time")
         else:
             loc_update_retry_wait_time = 1
-            
-        MoveThread(loc_cycle, move_time, handoff_time, loc_update_retries, loc_update_retry_wait_time).start()
+
+        # Time in seconds before each move to join the next locators, or 0 to join them at the move
+        if "prewarm_time" in config_section:
+            prewarm_time = config_section.getfloat("prewarm_time")
+        else:
+            prewarm_time = 0
+        if prewarm_time > move_time - handoff_time:
+            raise NetworkException("prewarm_time must be at most move_time - handoff_time")
+
+        # Locator updates aren't retransmitted less often than once a handoff
+        global loc_updates
+        loc_updates = retransmit.Retransmitter(loc_update_retries, handoff_time)
+        if handoff_policy == "cycle":
+            policy = handoff.CyclePolicy(loc_cycle, move_time)
+        else:
+            # Moves are at least move_time apart
+            policy = handoff.HysteresisPolicy(
+                loc_cycle, _locator_metrics, handoff_margin, handoff_hold_time, move_time
+            )
+        mover = Mover(policy, handoff_time, loc_update_retry_wait_time, prewarm_time)
+        if runtime == "asyncio":
+            loop.create_task(_move_coroutine(mover))
+        else:
+            MoveThread(mover).start()
+
+    if runtime == "asyncio":
+        LoopThread().start()
 
 
 startup()
@@ -57,7 +57,7 @@ class ReceiveThread(threading.Thread):
         while True:
             data, src_addrinfo, dst_addrinfo, interface = self.ilnp_sock.receive()
             local_port = dst_addrinfo[1]
-            print("%s <- %s: %s" % (local_port, src_addrinfo, data))
+            print("%s <- %s: %s" % (local_port, src_addrinfo, bytes(data)))
             try:
                 udp_sock.sendto(data, ("localhost", local_port))
             except transport.NetworkException as e:
@@ -0,0 +1,88 @@
+import math
+import threading
+import time
+
+# Retransmission timers for a message sent to many peers, each until it acknowledges.
+#
+# Each peer has its own timeout, starting at the one it was added with (e.g. derived
+# from its round trip time) and doubling on each retransmission up to max_timeout.
+# A peer stops being sent to as soon as it acknowledges, or is given up on once
+# it has been retransmitted to retries times and still not acknowledged.
+# How long each peer took to acknowledge is kept in completion_times.
+#
+# Polled rather than running its own timer, like trickle.Trickle, so it can be driven
+# by a thread or a coroutine. poll returns the peers to send to, and how long to wait
+# before polling again. ack may be called from any thread, and calls wake once
+# every peer has acknowledged so the driver can stop waiting.
+class Retransmitter:
+    def __init__(self, retries, max_timeout):
+        self.retries = retries
+        self.max_timeout = max_timeout
+        # Called when the last peer acknowledges, set by the driver
+        self.wake = None
+        self.lock = threading.Lock()
+        self.start({})
+
+    # Start sending to peers, a map of peers to their first timeouts,
+    # forgetting any previous peers. completed is a map of peers that have already
+    # acknowledged (e.g. an earlier message they've been sent) to their completion times.
+    def start(self, peers, completed=None):
+        now = time.monotonic()
+        with self.lock:
+            self.start_time = now
+            # peer -> [time due to be sent to, timeout, time last sent, retransmissions],
+            # where retransmissions is -1 until first sent
+            self.pending = {peer: [now, timeout, None, -1] for peer, timeout in peers.items()}
+            # peer -> seconds from start until it acknowledged, or None if given up on
+            self.completion_times = {} if completed == None else dict(completed)
+
+    # peer acknowledged. Returns (retransmissions, seconds since last sent to)
+    # if it was being sent to, otherwise None.
+    def ack(self, peer):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.pending.get(peer)
+            if entry == None or entry[2] == None:
+                return None
+            del self.pending[peer]
+            self.completion_times[peer] = now - self.start_time
+            done = len(self.pending) == 0
+        if done and self.wake != None:
+            self.wake()
+        return entry[3], now - entry[2]
+
+    # Returns ([(peer, retransmissions)] to send to now, wait),
+    # where wait is the time until poll should next be called
+    def poll(self):
+        now = time.monotonic()
+        due = []
+        next_due = math.inf
+        with self.lock:
+            for peer, entry in list(self.pending.items()):
+                if entry[0] <= now:
+                    if entry[3] >= self.retries:
+                        del self.pending[peer]
+                        self.completion_times[peer] = None
+                        continue
+                    # Exponential backoff
+                    if entry[3] >= 0:
+                        entry[1] = min(2 * entry[1], self.max_timeout)
+                    entry[3] += 1
+                    entry[0] = now + entry[1]
+                    entry[2] = now
+                    due.append((peer, entry[3]))
+                next_due = min(next_due, entry[0])
+        return due, max(0, next_due - now)
+
+    # Give up on the peers that haven't acknowledged, returning them
+    def cancel(self):
+        with self.lock:
+            peers = list(self.pending)
+            for peer in peers:
+                self.completion_times[peer] = None
+            self.pending = {}
+        return peers
+
+    # If every peer has acknowledged or been given up on
+    def done(self):
+        return len(self.pending) == 0
@@ -0,0 +1,316 @@
+import socket
+import os
+import time
+import random
+import heapq
+import itertools
+import tempfile
+import threading
+from collections import defaultdict
+
+import util
+
+# Simulated link layer, a drop in replacement for link layer emulation with IP multicast.
+#
+# Every locator is a broadcast domain, represented by a directory
+# containing an entry for each node that has joined it.
+# Nodes are Unix datagram sockets in the nodes directory,
+# so any number of nodes can run on one host, in one process each,
+# without multicast or a network interface.
+#
+# Frames are prefixed with the locator they were sent on:
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                                                               |
+# +                              Loc                              +
+# |                                                               |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |                             Frame                             |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+LOC_SIZE = 8
+
+NODES_DIR = "nodes"
+
+# Map of joined interfaces (locators) to their binary representation
+interfaces = {}
+
+# Map of binary locators to interfaces, for received frames
+bytes_to_interface = {}
+
+# Map of interfaces to (directory modification time, [(node, socket path)])
+members = {}
+
+# Frames waiting for simulated latency or bandwidth,
+# heap of (delivery time, sequence, interface, frame)
+delayed = []
+delayed_sequence = itertools.count()
+delay_cv = threading.Condition()
+
+# Map of interfaces to the time their simulated transmission is free
+next_free = {}
+
+# Map of interfaces to number of frames in delayed
+queued = defaultdict(int)
+
+
+def _get_members(interface):
+    loc_dir = os.path.join(sim_dir, interface)
+    mtime = os.stat(loc_dir).st_mtime_ns
+    entry = members.get(interface)
+    # Directory modification time changes when nodes join or leave
+    if entry == None or entry[0] != mtime:
+        entry = mtime, [
+            (node, os.path.join(sim_dir, NODES_DIR, node))
+            for node in os.listdir(loc_dir)
+        ]
+        members[interface] = entry
+    return entry[1]
+
+
+# Deliver frame, a list of buffers, to every member of the broadcast domain, including ourselves
+def _transmit(interface, frame):
+    for node, path in _get_members(interface):
+        if loss > 0 and random.random() < loss:
+            continue
+        try:
+            sock.sendmsg(frame, (), socket.MSG_DONTWAIT, path)
+        except BlockingIOError:
+            # Receive buffer full, drop like a real link would
+            pass
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Node exited without leaving, remove it from the broadcast domain
+            try:
+                os.remove(os.path.join(sim_dir, interface, node))
+            except OSError:
+                pass
+
+
+def _schedule(interface, frame):
+    with delay_cv:
+        # Drop tail if the simulated transmission queue is full
+        if queued[interface] >= queue_size:
+            return
+        now = time.monotonic()
+        delivery_time = now + latency
+        if bandwidth != None:
+            transmission_start = max(now, next_free.get(interface, now))
+            next_free[interface] = transmission_start + sum(map(len, frame)) * 8 / bandwidth
+            delivery_time = next_free[interface] + latency
+        queued[interface] += 1
+        heapq.heappush(delayed, (delivery_time, next(delayed_sequence), interface, frame))
+        delay_cv.notify()
+
+
+# Sends the concatenation of buffers (bytes like objects) as one frame
+def send(interface, *buffers):
+    loc_bytes = interfaces.get(interface)
+    if loc_bytes == None:
+        raise IOError("Not joined interface '%s'" % interface)
+    length = sum(map(len, buffers))
+    if length > buffer_size:
+        raise IOError("data length larger than buffer size: %d > %d" %
+            (length, buffer_size)
+        )
+    if log_file != None:
+        util.write_log(log_file, "%-45s <- %-45s %s" % (
+            "[%s]" % interface,
+            "[%s]" % local_addr,
+            util.format_data(list(buffers), 64)
+        ))
+    if latency == 0 and bandwidth == None:
+        _transmit(interface, [loc_bytes, *buffers])
+    else:
+        # Copy, as the buffers may be reused before the frame is transmitted
+        _schedule(interface, [loc_bytes + b"".join(buffers)])
+
+
+# Sends a list of (interface, *buffers) frames
+def send_batch(frames):
+    for interface, *buffers in frames:
+        send(interface, *buffers)
+
+
+# Number of frames waiting for simulated latency or bandwidth on interface
+def queue_length(interface):
+    return queued.get(interface, 0)
+
+
+def join(interface):
+    if interface in interfaces:
+        raise IOError("Already joined interface '%s'" % interface)
+    loc_dir = os.path.join(sim_dir, interface)
+    os.makedirs(loc_dir, exist_ok=True)
+    open(os.path.join(loc_dir, local_addr), "w").close()
+
+    loc_bytes = util.hex_to_bytes(interface, LOC_SIZE)
+    interfaces[interface] = loc_bytes
+    bytes_to_interface[loc_bytes] = interface
+
+    if log_file != None:
+        util.write_log(log_file, ("Joined %s" % loc_dir))
+
+
+def leave(interface):
+    loc_bytes = interfaces.pop(interface, None)
+    if loc_bytes == None:
+        raise IOError("Not joined interface '%s'" % interface)
+    bytes_to_interface.pop(loc_bytes, None)
+    loc_dir = os.path.join(sim_dir, interface)
+    os.remove(os.path.join(loc_dir, local_addr))
+
+    if log_file != None:
+        util.write_log(log_file, ("Removed %s" % loc_dir))
+
+
+def _parse(nbytes, from_address):
+    # Frame was received into receive_buffer
+    loc_bytes = bytes(receive_buffer.take(LOC_SIZE))
+    data = receive_buffer.take(nbytes - LOC_SIZE)
+    recived_interface = bytes_to_interface.get(loc_bytes)
+    if recived_interface == None:
+        # Not (or no longer) joined, e.g. after leaving during a handoff
+        recived_interface = util.bytes_to_hex(loc_bytes)
+    # Node names are the final component of their socket path
+    from_node = os.path.basename(from_address)
+
+    if log_file != None:
+        util.write_log(log_file, "%-45s -> %-45s %s" % (
+            "[%s]" % from_node,
+            "[%s]" % recived_interface,
+            util.format_data(data, 64)
+        ))
+    return data, recived_interface, from_node
+
+
+# Let the memory of a received frame be reused, once it's no longer referenced
+def release(data):
+    receive_buffer.release(data)
+
+
+# interface is unused as there is one socket for all interfaces
+def receive(interface=None):
+    nbytes, ancdata, msg_flags, from_address = sock.recvmsg_into(
+        [receive_buffer.get()[:buffer_size + LOC_SIZE]]
+    )
+    return _parse(nbytes, from_address)
+
+
+def _receive_ready(batch):
+    recvmsg_into = sock.recvmsg_into
+    while len(batch) < batch_size:
+        try:
+            nbytes, ancdata, msg_flags, from_address = recvmsg_into(
+                [receive_buffer.get()[:buffer_size + LOC_SIZE]], 0, socket.MSG_DONTWAIT
+            )
+        except BlockingIOError:
+            break
+        batch.append(_parse(nbytes, from_address))
+    return batch
+
+
+def receive_batch(interface=None):
+    return _receive_ready([receive()])
+
+
+def receive_ready(interface=None):
+    return _receive_ready([])
+
+
+def receive_socket(interface=None):
+    return sock
+
+
+# Transmits frames once their simulated latency and transmission time has passed
+class DelayThread(threading.Thread):
+    def run(self):
+        while True:
+            with delay_cv:
+                while len(delayed) == 0:
+                    delay_cv.wait()
+                delivery_time, _, interface, frame = delayed[0]
+                remaining = delivery_time - time.monotonic()
+                if remaining > 0:
+                    delay_cv.wait(remaining)
+                    continue
+                heapq.heappop(delayed)
+                queued[interface] -= 1
+            try:
+                _transmit(interface, frame)
+            except Exception as e:
+                if log_file != None:
+                    util.write_log(log_file, "Error transmitting: %s" % e)
+
+
+def startup():
+    config_section = util.config["link"]
+
+    global buffer_size, batch_size
+    buffer_size = config_section.getint("buffer_size")
+    # Frames are received into this, and passed up the stack without copying
+    global receive_buffer
+    receive_buffer = util.ReceiveBuffer(buffer_size + LOC_SIZE)
+    if "batch_size" in config_section:
+        batch_size = config_section.getint("batch_size")
+    else:
+        batch_size = 1
+
+    # Directory of the simulated link, shared by all nodes on the host
+    global sim_dir
+    if "sim_dir" in config_section:
+        sim_dir = config_section["sim_dir"]
+    else:
+        sim_dir = os.path.join(tempfile.gettempdir(), "ilnp-sim-%d" % os.getuid())
+
+    # Name of the node on the simulated link, which must be unique
+    global local_addr
+    if "sim_node" in config_section:
+        local_addr = config_section["sim_node"]
+    else:
+        local_addr = util.config["discovery"]["hostname"]
+
+    # One way latency in seconds
+    global latency
+    if "sim_latency" in config_section:
+        latency = config_section.getfloat("sim_latency")
+    else:
+        latency = 0
+
+    # Probability of a frame being lost, independently for each receiver
+    global loss
+    if "sim_loss" in config_section:
+        loss = config_section.getfloat("sim_loss")
+    else:
+        loss = 0
+
+    # Bandwidth of each locator in bits per second, unlimited if not set
+    global bandwidth
+    if "sim_bandwidth" in config_section:
+        bandwidth = config_section.getfloat("sim_bandwidth")
+    else:
+        bandwidth = None
+
+    # Maximum number of frames waiting for latency or bandwidth on each locator
+    global queue_size
+    if "sim_queue_size" in config_section:
+        queue_size = config_section.getint("sim_queue_size")
+    else:
+        queue_size = 1000
+
+    global log_file
+    log_file = util.get_log_file("link")
+
+    node_path = os.path.join(sim_dir, NODES_DIR, local_addr)
+    os.makedirs(os.path.dirname(node_path), exist_ok=True)
+    try:
+        os.remove(node_path)
+    except OSError:
+        pass
+
+    global sock
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    # Set to blocking
+    sock.settimeout(None)
+    sock.bind(node_path)
+
+    if latency > 0 or bandwidth != None:
+        DelayThread().start()
@@ -0,0 +1,87 @@
+import struct
+import os
+import time
+
+# Snapshots of learnt state, so a restarted node can forward and resolve
+# straight away rather than waiting to learn it all again.
+#
+# A snapshot is a header followed by fixed size records, all big endian:
+#   header:     magic, format version, time written (time.time),
+#               number of forwarding records, number of host records
+#   forwarding: loc, interface, seconds until expiry
+#   host:       loc, nid, seconds until expiry, hostname length, hostname (padded)
+# Times until expiry are relative to the time written, and are rebased on reading.
+
+MAGIC = b"ILNS"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("!4sBdII")
+FORWARDING_RECORD = struct.Struct("!8s8sf")
+HOSTNAME_SIZE = 64
+HOST_RECORD = struct.Struct("!8s8sfB%ds" % HOSTNAME_SIZE)
+
+
+# Write a snapshot to path, replacing it atomically.
+# forwarding is [(loc bytes, interface bytes, seconds until expiry)],
+# hosts is [(hostname, loc bytes, nid bytes, seconds until expiry)].
+def write(path, forwarding, hosts):
+    hosts = [
+        (hostname.encode("utf-8"), loc, nid, remaining)
+        for hostname, loc, nid, remaining in hosts
+    ]
+    # Hostnames too long for a record aren't saved
+    hosts = [entry for entry in hosts if len(entry[0]) <= HOSTNAME_SIZE]
+    buffer = bytearray(
+        HEADER.size + len(forwarding) * FORWARDING_RECORD.size + len(hosts) * HOST_RECORD.size
+    )
+    HEADER.pack_into(buffer, 0, MAGIC, FORMAT_VERSION, time.time(), len(forwarding), len(hosts))
+    offset = HEADER.size
+    for loc, interface, remaining in forwarding:
+        FORWARDING_RECORD.pack_into(buffer, offset, loc, interface, remaining)
+        offset += FORWARDING_RECORD.size
+    for hostname, loc, nid, remaining in hosts:
+        HOST_RECORD.pack_into(buffer, offset, loc, nid, remaining, len(hostname), hostname)
+        offset += HOST_RECORD.size
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(buffer)
+    os.replace(temporary_path, path)
+
+
+# Read a snapshot from path, returning (forwarding, hosts) as passed to write,
+# with times until expiry rebased to now and expired entries left out.
+# Returns empty lists if there is no snapshot, and raises IOError if it is invalid.
+def read(path):
+    try:
+        with open(path, "rb") as f:
+            buffer = f.read()
+    except FileNotFoundError:
+        return [], []
+    try:
+        magic, format_version, written, forwarding_count, host_count = HEADER.unpack_from(buffer)
+    except struct.error:
+        raise IOError("Truncated snapshot '%s'" % path)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise IOError("Not a snapshot '%s'" % path)
+    expected_size = (
+        HEADER.size + forwarding_count * FORWARDING_RECORD.size + host_count * HOST_RECORD.size
+    )
+    if len(buffer) != expected_size:
+        raise IOError("Truncated snapshot '%s'" % path)
+
+    # Time since written
+    age = max(0, time.time() - written)
+    forwarding = []
+    for loc, interface, remaining in FORWARDING_RECORD.iter_unpack(
+        buffer[HEADER.size:HEADER.size + forwarding_count * FORWARDING_RECORD.size]
+    ):
+        if remaining > age:
+            forwarding.append((loc, interface, remaining - age))
+    hosts = []
+    for loc, nid, remaining, hostname_length, hostname in HOST_RECORD.iter_unpack(
+        buffer[HEADER.size + forwarding_count * FORWARDING_RECORD.size:]
+    ):
+        if remaining > age:
+            hosts.append((str(hostname[:hostname_length], "utf-8"), loc, nid, remaining - age))
+    return forwarding, hosts
@@ -0,0 +1,520 @@
+import math
+import heapq
+import threading
+import time
+import collections
+from collections import defaultdict
+
+
+# Map of binary locators to interfaces (which are locators this node has joined).
+#
+# Mappings are either static, for joined locators, or learnt by backwards
+# learning and expire ttl seconds after they were last learnt.
+# Expiry is driven by a timer wheel advanced every tick seconds by advance(),
+# so lookups and learning never read the clock.
+#
+# The table is read on every packet and changed rarely, so it is copy on write:
+# changes are made to a copy of interfaces under lock, which then replaces it,
+# and lookups read whichever snapshot is current without locking.
+# Refreshing an existing mapping doesn't change interfaces, so doesn't lock either.
+class ForwardingTable:
+    def __init__(self, ttl, tick=1):
+        # loc -> interface, replaced rather than changed
+        self.interfaces = {}
+        # loc -> [tick the mapping expires at], for learnt mappings.
+        # Single element lists so refreshes can update them in place without locking.
+        self.expiries = {}
+        # interface -> set of locs mapped to it
+        self.by_interface = defaultdict(set)
+        # Held while changing interfaces, expiries, by_interface, or wheel
+        self.lock = threading.Lock()
+
+        self.tick_time = tick
+        self.ttl_ticks = max(1, math.ceil(ttl / tick))
+        self.tick = 0
+        # Slot (expiry tick modulo number of slots) -> set of locs.
+        # A loc is slotted by the expiry it had when slotted, and is
+        # re-slotted when that slot is reached if it has been learnt since.
+        self.wheel = [set() for _ in range(self.ttl_ticks + 1)]
+
+    def lookup(self, loc):
+        return self.interfaces.get(loc)
+
+    # Learn loc is reachable via interface.
+    # Returns True if this is a new mapping.
+    def learn(self, loc, interface):
+        if self.interfaces.get(loc) == interface:
+            expiry = self.expiries.get(loc)
+            # Static mappings aren't replaced by learnt ones
+            if expiry != None:
+                # Refresh, slotted lazily by advance
+                expiry[0] = self.tick + self.ttl_ticks
+            return False
+        with self.lock:
+            interfaces = dict(self.interfaces)
+            self._remove(interfaces, loc)
+            self._add(interfaces, loc, interface)
+            expiry = self.tick + self.ttl_ticks
+            self.expiries[loc] = [expiry]
+            self.wheel[expiry % len(self.wheel)].add(loc)
+            self.interfaces = interfaces
+        return True
+
+    # Add a learnt mapping expiring in ttl seconds, unless learnt again,
+    # e.g. loaded from a snapshot. Doesn't replace existing mappings.
+    def add_provisional(self, loc, interface, ttl):
+        with self.lock:
+            if loc in self.interfaces:
+                return
+            interfaces = dict(self.interfaces)
+            self._add(interfaces, loc, interface)
+            expiry = self.tick + min(self.ttl_ticks, max(1, math.ceil(ttl / self.tick_time)))
+            self.expiries[loc] = [expiry]
+            self.wheel[expiry % len(self.wheel)].add(loc)
+            self.interfaces = interfaces
+
+    # Returns [(loc, interface, seconds until expiry)] of learnt mappings
+    def learnt(self):
+        with self.lock:
+            return [
+                (loc, self.interfaces[loc], (expiry[0] - self.tick) * self.tick_time)
+                for loc, expiry in self.expiries.items()
+            ]
+
+    # Add a non-expiring mapping
+    def add_static(self, loc, interface):
+        with self.lock:
+            interfaces = dict(self.interfaces)
+            self._remove(interfaces, loc)
+            self._add(interfaces, loc, interface)
+            self.interfaces = interfaces
+
+    # Remove all mappings to interface
+    def purge_interface(self, interface):
+        with self.lock:
+            locs = self.by_interface.pop(interface, ())
+            if len(locs) == 0:
+                return
+            interfaces = dict(self.interfaces)
+            for loc in locs:
+                del interfaces[loc]
+                self.expiries.pop(loc, None)
+            self.interfaces = interfaces
+
+    def _add(self, interfaces, loc, interface):
+        interfaces[loc] = interface
+        self.by_interface[interface].add(loc)
+
+    def _remove(self, interfaces, loc):
+        interface = interfaces.pop(loc, None)
+        if interface == None:
+            return
+        self.expiries.pop(loc, None)
+        locs = self.by_interface.get(interface)
+        if locs != None:
+            locs.discard(loc)
+            if len(locs) == 0:
+                del self.by_interface[interface]
+
+    # Expire mappings, to be called every tick_time seconds
+    def advance(self):
+        with self.lock:
+            self.tick += 1
+            index = self.tick % len(self.wheel)
+            slot = self.wheel[index]
+            self.wheel[index] = set()
+            expired = []
+            for loc in slot:
+                expiry = self.expiries.get(loc)
+                # Removed, or now static
+                if expiry == None:
+                    continue
+                if expiry[0] <= self.tick:
+                    expired.append(loc)
+                else:
+                    self.wheel[expiry[0] % len(self.wheel)].add(loc)
+            if len(expired) > 0:
+                interfaces = dict(self.interfaces)
+                for loc in expired:
+                    self._remove(interfaces, loc)
+                self.interfaces = interfaces
+
+    def __len__(self):
+        return len(self.interfaces)
+
+
+# Map of keys to the time (time.monotonic) they were last touched.
+#
+# Touched on every packet sent and received, from any thread, and read rarely,
+# so each thread touches its own shard without locking,
+# and readers merge the shards.
+class ActivityTable:
+    def __init__(self):
+        self.local = threading.local()
+        # [(thread, shard)], replaced rather than changed
+        self.shards = []
+        # Held while changing shards
+        self.lock = threading.Lock()
+
+    def touch(self, key):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self._add_shard()
+        shard[key] = time.monotonic()
+
+    def _add_shard(self):
+        shard = {}
+        self.local.shard = shard
+        with self.lock:
+            self.shards = self.shards + [(threading.current_thread(), shard)]
+        return shard
+
+    # Returns keys touched in the past ttl seconds, forgetting the rest
+    def active(self, ttl):
+        now = time.monotonic()
+        active = {}
+        with self.lock:
+            for thread, shard in self.shards:
+                # Copying a dict doesn't release the GIL,
+                # so it can't change size while being copied
+                for key, timestamp in shard.copy().items():
+                    if now - timestamp > ttl:
+                        # Unless touched since it was copied
+                        if shard.get(key) == timestamp:
+                            shard.pop(key, None)
+                    elif timestamp > active.get(key, 0):
+                        active[key] = timestamp
+            # Forget shards of exited threads, e.g. receive threads of left locators
+            self.shards = [
+                (thread, shard) for thread, shard in self.shards
+                if thread.is_alive() or len(shard) > 0
+            ]
+        return list(active)
+
+
+# Set of recently seen keys, each forgotten ttl seconds after it was first seen,
+# or once capacity newer keys have been seen, whichever is sooner.
+class SeenCache:
+    def __init__(self, ttl, capacity=4096):
+        self.ttl = ttl
+        self.capacity = capacity
+        # key -> time first seen (time.monotonic), oldest first
+        self.seen = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns True if key was seen recently, otherwise remembers it and returns False
+    def check(self, key):
+        now = time.monotonic()
+        with self.lock:
+            seen = self.seen
+            # Keys expire in the order they were seen
+            while len(seen) > 0:
+                oldest, timestamp = next(iter(seen.items()))
+                if now - timestamp <= self.ttl and len(seen) < self.capacity:
+                    break
+                seen.popitem(last=False)
+            if key in seen:
+                return True
+            seen[key] = now
+            return False
+
+    def __len__(self):
+        return len(self.seen)
+
+
+# Sliding window of the 32 bit sequence numbers received in a stream, to drop duplicates.
+#
+# Keeps the highest sequence number received, compared with serial number arithmetic
+# (RFC 1982) so they may wrap, and a bitmap of which of the size below it were received,
+# like IPsec's anti-replay window. Packets reordered by up to size are still accepted,
+# while those further behind are dropped as too old, and counted with the duplicates.
+# Sequence numbers that leave the window without having been received, or that are
+# jumped over entirely, are counted as lost, up to size at a time.
+class SequenceWindow:
+    def __init__(self, size=64):
+        self.size = size
+        # Highest sequence number received, or None if none have been
+        self.highest = None
+        # Bit i set if highest - i was received
+        self.bitmap = 0
+        # Number of sequence numbers in the window since the first received, up to size
+        self.span = 0
+        # Duplicates and packets too old dropped
+        self.duplicates = 0
+        self.lost = 0
+        # Lost since take_lost was last called
+        self.unreported_lost = 0
+        self.lock = threading.Lock()
+
+    # Returns True if sequence_number is new, remembering it, or False if it's a duplicate or too old
+    def check(self, sequence_number):
+        with self.lock:
+            if self.highest != None:
+                difference = (sequence_number - self.highest) & 0xffffffff
+                if difference == 0:
+                    self.duplicates += 1
+                    return False
+                if difference < 0x80000000:
+                    # Ahead, so slide the window up, counting those sliding out unreceived
+                    if difference < self.size:
+                        leaving = self.bitmap >> (self.size - difference)
+                        lost = max(0, self.span - (self.size - difference)) - bin(leaving).count("1")
+                        self.bitmap = ((self.bitmap << difference) | 1) & ((1 << self.size) - 1)
+                    else:
+                        # The whole window slides out, and those between it and the new one are skipped
+                        lost = self.span - bin(self.bitmap).count("1") + difference - self.size
+                        self.bitmap = 1
+                    lost = min(max(0, lost), self.size)
+                    self.lost += lost
+                    self.unreported_lost += lost
+                    self.span = min(self.size, self.span + difference)
+                    self.highest = sequence_number
+                    return True
+                else:
+                    behind = 0x100000000 - difference
+                    if behind >= self.size or self.bitmap & (1 << behind):
+                        self.duplicates += 1
+                        return False
+                    self.bitmap |= 1 << behind
+                    return True
+            self.highest = sequence_number
+            self.bitmap = 1
+            self.span = 1
+            return True
+
+    # Returns the number of sequence numbers lost since it was last called
+    def take_lost(self):
+        with self.lock:
+            lost = self.unreported_lost
+            self.unreported_lost = 0
+        return lost
+
+
+# Map of hostnames to the ILVs they were discovered at, and of ILVs to hostnames.
+#
+# Mappings expire ttl seconds after they were last learnt, or the ttl they were learnt with.
+# Expiry is driven by expire(), which pops a heap of (expiry time, ilv) entries.
+# An ILV is in the heap at the expiry it had when pushed, and is re-pushed when popped
+# if it has been learnt since.
+#
+# A hostname resolves to the ILV chosen by select from those not expired or removed,
+# by default the one it was first learnt at. If cache is True resolutions are cached
+# until the hostname's ILVs change, or are refreshed if refresh_invalidates is True,
+# or invalidate is called, so a hit is one dict lookup.
+# Lookups don't lock, changes are made under lock.
+class HostMap:
+    def __init__(self, ttl, select=None, cache=True, refresh_invalidates=False):
+        self.ttl = ttl
+        # Given a hostname's ILVs in the order they were learnt, returns the one to resolve to
+        self.select = select if select != None else _select_first
+        self.cache = cache
+        self.refresh_invalidates = refresh_invalidates
+        # hostname -> {ilv: None}, an ordered set of the ILVs it can be reached at
+        self.by_hostname = {}
+        # ilv -> hostname, including ILVs removed from by_hostname until they expire,
+        # so packets still in flight from a host's old ILVs are recognised
+        self.hostnames = {}
+        # ilv -> time the mapping expires at (time.monotonic)
+        self.expiries = {}
+        # Heap of (expiry time, ilv)
+        self.heap = []
+        # hostname -> ilv, cached resolutions
+        self.resolved = {}
+        # Held while changing any of the above
+        self.lock = threading.Lock()
+
+    # Returns the ILV hostname resolves to, or None
+    def resolve(self, hostname):
+        ilv = self.resolved.get(hostname)
+        if ilv != None:
+            return ilv
+        with self.lock:
+            ilvs = self.by_hostname.get(hostname)
+            if ilvs == None:
+                return None
+            ilv = self.select(ilvs)
+            if self.cache:
+                self.resolved[hostname] = ilv
+            return ilv
+
+    # Returns [(hostname, ilv, seconds until expiry)] of the ILVs hostnames resolve to
+    def entries(self):
+        now = time.monotonic()
+        with self.lock:
+            return [
+                (hostname, ilv, self.expiries[ilv] - now)
+                for hostname, ilvs in self.by_hostname.items()
+                for ilv in ilvs
+            ]
+
+    # Returns hostnames with cached resolutions to ILVs expiring in the next within seconds,
+    # forgetting those resolutions so they're only returned again once looked up again
+    def take_expiring(self, within):
+        deadline = time.monotonic() + within
+        with self.lock:
+            expiring = [
+                hostname for hostname, ilv in self.resolved.items()
+                if self.expiries.get(ilv, 0) <= deadline
+            ]
+            for hostname in expiring:
+                del self.resolved[hostname]
+        return expiring
+
+    # Forget cached resolutions, e.g. when what select chooses by has changed
+    def invalidate(self):
+        with self.lock:
+            self.resolved.clear()
+
+    # Returns the hostname at ilv, or None
+    def hostname(self, ilv):
+        return self.hostnames.get(ilv)
+
+    # Returns the ILVs hostname can be reached at, in the order they were learnt
+    def ilvs(self, hostname):
+        return list(self.by_hostname.get(hostname, ()))
+
+    # Learn hostname can be reached at ilv, for ttl seconds if given.
+    # Returns True if this is a new mapping.
+    def learn(self, hostname, ilv, ttl=None):
+        if ttl == None:
+            ttl = self.ttl
+        with self.lock:
+            return self._learn(hostname, ilv, time.monotonic() + ttl)
+
+    # Atomically stop resolving hostname to the removed ILVs, and learn the added ones,
+    # for ttl seconds if given. If replace_nid is given, the hostname's other ILVs
+    # with that NID are removed too, so the added ones replace them.
+    # The removed ILVs still map back to the hostname until they expire.
+    # Returns True if any added ILV is new.
+    def update(self, hostname, removed, added, ttl=None, replace_nid=None):
+        if ttl == None:
+            ttl = self.ttl
+        with self.lock:
+            ilvs = self.by_hostname.get(hostname)
+            if ilvs != None:
+                if replace_nid != None:
+                    suffix = ":" + replace_nid
+                    removed = list(removed) + [
+                        ilv for ilv in ilvs if ilv.endswith(suffix) and ilv not in added
+                    ]
+                for ilv in removed:
+                    self._forget(hostname, ilv)
+            expiry = time.monotonic() + ttl
+            new = False
+            for ilv in added:
+                new = self._learn(hostname, ilv, expiry) or new
+            return new
+
+    # Returns True if ilv is new to hostname's ILVs
+    def _learn(self, hostname, ilv, expiry):
+        # Refreshes to a later expiry are re-pushed lazily by expire
+        if expiry < self.expiries.get(ilv, math.inf):
+            heapq.heappush(self.heap, (expiry, ilv))
+        self.expiries[ilv] = expiry
+        previous = self.hostnames.get(ilv)
+        if previous != None and previous != hostname:
+            self._forget(previous, ilv)
+        self.hostnames[ilv] = hostname
+        ilvs = self.by_hostname.get(hostname)
+        if ilvs == None:
+            self.by_hostname[hostname] = {ilv: None}
+        elif ilv not in ilvs:
+            ilvs[ilv] = None
+        else:
+            if self.refresh_invalidates and self.resolved.get(hostname) != ilv:
+                self.resolved.pop(hostname, None)
+            return False
+        self.resolved.pop(hostname, None)
+        return True
+
+    # Remove ilv from hostname's ILVs
+    def _forget(self, hostname, ilv):
+        ilvs = self.by_hostname.get(hostname)
+        if ilvs == None or ilv not in ilvs:
+            return
+        del ilvs[ilv]
+        if len(ilvs) == 0:
+            del self.by_hostname[hostname]
+        if self.resolved.get(hostname) == ilv:
+            del self.resolved[hostname]
+
+    # Remove expired mappings
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            heap = self.heap
+            while len(heap) > 0 and heap[0][0] <= now:
+                _, ilv = heapq.heappop(heap)
+                expiry = self.expiries.get(ilv)
+                # Already expired by another entry, as one is pushed when an expiry is brought forward
+                if expiry == None:
+                    continue
+                if expiry > now:
+                    heapq.heappush(heap, (expiry, ilv))
+                    continue
+                del self.expiries[ilv]
+                self._forget(self.hostnames.pop(ilv), ilv)
+
+    def __len__(self):
+        return len(self.hostnames)
+
+
+def _select_first(ilvs):
+    return next(iter(ilvs))
+
+
+# Round trip time and loss estimates of locators, from the samples measured.
+# Round trip times are smoothed as TCP does (RFC 6298),
+# and loss rates are exponentially weighted moving averages.
+class LocatorStats:
+    # Weights of new samples
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self):
+        # loc -> (smoothed round trip time, round trip time variation), in seconds
+        self.rtts = {}
+        # loc -> loss rate, between 0 and 1
+        self.losses = {}
+        self.lock = threading.Lock()
+
+    def rtt_sample(self, loc, rtt):
+        with self.lock:
+            entry = self.rtts.get(loc)
+            if entry == None:
+                self.rtts[loc] = rtt, rtt / 2
+            else:
+                srtt, rttvar = entry
+                rttvar = (1 - self.BETA) * rttvar + self.BETA * abs(srtt - rtt)
+                srtt = (1 - self.ALPHA) * srtt + self.ALPHA * rtt
+                self.rtts[loc] = srtt, rttvar
+
+    # lost is True if count packets to loc were lost, and False if they were delivered
+    def loss_sample(self, loc, lost, count=1):
+        # count samples at once, in closed form
+        weight = (1 - self.ALPHA) ** count
+        with self.lock:
+            loss = self.losses.get(loc, 0)
+            if lost:
+                self.losses[loc] = 1 - weight * (1 - loss)
+            else:
+                self.losses[loc] = weight * loss
+
+    # Smoothed round trip time to loc, or None if not measured
+    def rtt(self, loc):
+        entry = self.rtts.get(loc)
+        if entry == None:
+            return None
+        return entry[0]
+
+    def loss(self, loc):
+        return self.losses.get(loc, 0)
+
+    # Retransmission timeout for loc, or None if not measured
+    def rto(self, loc):
+        entry = self.rtts.get(loc)
+        if entry == None:
+            return None
+        srtt, rttvar = entry
+        return srtt + 4 * rttvar
@@ -1,26 +1,58 @@
 import struct
 import collections
 import threading
+import asyncio
 import time
 import os
+import secrets
 
 import network
+import tables
 import util
 from util import NetworkException
 
 PROTOCOL_NEXT_HEADER = 42
 
-# Map of input circular queues indexed by local port
+# Transport header: 16 bit source and destination ports, and 32 bit epoch and sequence number.
+# The epoch is random for each flow, so a restarted (or forgotten) flow's sequence numbers
+# aren't taken as duplicates of its previous ones.
+HEADER = struct.Struct("!2s2sII")
+
+# Map of input queues (util.PacketQueue) indexed by local port
 in_queues = {}
 
+# Map of local ports to the sockets bound to them
+bound_sockets = {}
+
+# Map of local ports to deques of futures of coroutines waiting in Socket.async_receive,
+# in the order they started waiting, for the asyncio runtime
+receive_waiters = collections.defaultdict(collections.deque)
+
+# Map of (source NID, source port, destination port) to
+# [epoch, tables.SequenceWindow, tick (of network.loc_to_interface) last received]
+# of the packets received from it, to drop duplicates, e.g. those bicast during a soft handoff.
+# Keyed on NID rather than ILV, as duplicates may come from different locators.
+# A new epoch is a new flow, whose sequence numbers start again in a new window.
+# Idle flows are forgotten, see network.is_idle.
+sequence_windows = {}
+sequence_windows_lock = threading.Lock()
+
 
 class Socket:
+    def __init__(self):
+        # Map of remote (nid, port) to [epoch, next sequence number to send it, tick last sent to]
+        self.sequence_numbers = {}
+        # Map of remote (ilv, port) to [network flow label of packets to it, tick last sent to],
+        # so the network caches the route and header of each flow
+        self.flow_labels = {}
+
     # Bind the socket to a port to receive 
     def bind(self, port):
         if port in in_queues:
             raise NetworkException("Port %d already bound" % port)
-        in_queue = collections.deque(maxlen=None)
+        in_queue = util.PacketQueue(queue_capacity, queue_policy)
         in_queues[port] = in_queue
+        bound_sockets[port] = self
         self.port = port
         self.in_queue = in_queue
         self.receive_cv = None
@@ -41,21 +73,40 @@ class Socket:
         remote_ilv, remote_port = remote
         remote_loc = ":".join(remote_ilv.split(":")[:4])
         remote_nid = ":".join(remote_ilv.split(":")[4:])
-        # Transport header is just 16 bit source and destination ports
-        header = struct.pack("!2s2s",
+        tick = network.loc_to_interface.tick
+        key = (remote_nid, remote_port)
+        sequence = self.sequence_numbers.get(key)
+        if sequence == None:
+            sequence = [secrets.randbits(32), 0, tick]
+            self.sequence_numbers[key] = sequence
+        sequence_number = sequence[1]
+        sequence[1] = (sequence_number + 1) & 0xffffffff
+        sequence[2] = tick
+        header = HEADER.pack(
             util.int_to_bytes(self.port, 2),
-            util.int_to_bytes(remote_port, 2)
+            util.int_to_bytes(remote_port, 2),
+            sequence[0],
+            sequence_number
+        )
+        flow = self.flow_labels.get(remote)
+        if flow == None:
+            flow = [network.new_flow_label(), tick]
+            self.flow_labels[remote] = flow
+        flow[1] = tick
+        # Header and data are gathered when sent rather than concatenated
+        interface = network.send(
+            remote_loc, remote_nid, [header, data], PROTOCOL_NEXT_HEADER, flow_label=flow[0]
         )
-        message = header + data
-        interface = network.send(remote_loc, remote_nid, message, PROTOCOL_NEXT_HEADER)
         if log_file != None:
             util.write_log(log_file, "%-30s <- %-30s %s" % (
                 "[%s:%s%%%s]:%d" % (remote_loc, remote_nid, interface, remote_port),
                 "[%s:%s]:%d" % (interface, network.local_nid, self.port),
-                (str(data[:29]) + "...") if len(data) > 32 else data
+                util.format_data(data, 32)
             ))
         return interface
 
+    # Returns (data, src_addrinfo, dst_addrinfo, interface),
+    # with data a memoryview of the received packet rather than a copy.
     def receive(self):
         try:
             if len(self.in_queue) > 0:
@@ -69,57 +120,154 @@ class Socket:
         except AttributeError:
             raise NetworkException("Socket is not bound to a port.")
 
+    # Coroutine versions of send and receive, for the asyncio runtime.
+    # They must be run on the network's event loop, see run.
+
+    # Sending a datagram doesn't wait, so this is the same as send
+    async def async_send(self, remote, data):
+        return self.send(remote, data)
 
-class ReceiveThread(threading.Thread):
-    def run(self):
-        global receive_cvs
-        while True:
+    # Waits for a packet, without blocking the event loop
+    async def async_receive(self):
+        try:
+            in_queue = self.in_queue
+        except AttributeError:
+            raise NetworkException("Socket is not bound to a port.")
+        while len(in_queue) == 0:
+            waiter = network.loop.create_future()
+            waiters = receive_waiters[self.port]
+            waiters.append(waiter)
             try:
-                message, src_loc, src_nid, dst_loc, dst_nid, interface = network.receive(PROTOCOL_NEXT_HEADER)
-            # Input queue empty (or non-existant) for next header PROTOCOL_NEXT_HEADER
-            except (IndexError, KeyError):
-                with network.receive_cvs[PROTOCOL_NEXT_HEADER]:
-                    network.receive_cvs[PROTOCOL_NEXT_HEADER].wait()
-                continue
-            except :
-                raise NetworkException("Invalid next header: %d" % PROTOCOL_NEXT_HEADER)
-            header = message[:4]
-            sre_port_bytes, dst_port_bytes = struct.unpack("!2s2s", header)
-            src_port = util.bytes_to_int(sre_port_bytes)
-            dst_port = util.bytes_to_int(dst_port_bytes)
-            data = message[4:]
-            # drop if not valid port (if there"s no socket bound to this port)
-            if dst_port not in in_queues:
-                continue
-            in_queues.setdefault(
-                dst_port, collections.deque(maxlen=None)
-            ).append((
-                data,
-                (":".join([src_loc, src_nid]), src_port),
-                (":".join([dst_loc, dst_nid]), dst_port),
-                interface
-            ))
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                elif not waiter.cancelled():
+                    # Woken for a packet, so pass it on to the next waiter
+                    _wake(self.port)
+                raise
+        return in_queue.popleft()
+
+
+# Runs coroutine on the network's event loop, returning its result once done.
+# Called from outside the event loop, e.g. from an application's main thread.
+def run(coroutine):
+    if network.runtime != "asyncio":
+        raise NetworkException("Not running the asyncio runtime")
+    return asyncio.run_coroutine_threadsafe(coroutine, network.loop).result()
 
-            if dst_port in receive_cvs:
-                with receive_cvs[dst_port]:
-                    receive_cvs[dst_port].notify()
 
-            if log_file != None:
-                util.write_log(log_file, "%-30s -> %-30s %s" % (
-                    "[%s:%s%%%s]:%d" % (src_loc, src_nid, interface, src_port),
-                    "[%s:%s]:%d" % (dst_loc, dst_nid, dst_port),
-                    (str(data[:29]) + "...") if len(data) > 32 else data
-                ))
+# Returns {port: (queued, high water mark, dropped)} of in_queues
+def queue_stats():
+    return {
+        port: (len(in_queue), in_queue.high_water, in_queue.dropped)
+        for port, in_queue in list(in_queues.items())
+    }
+
+
+# Returns {(source NID, source port, destination port): duplicates dropped}
+def duplicate_stats():
+    return {key: entry[1].duplicates for key, entry in list(sequence_windows.items())}
+
+
+# Forget idle flows, so they don't accumulate. Called every network tick.
+def _expire():
+    for socket in list(bound_sockets.values()):
+        for table in (socket.sequence_numbers, socket.flow_labels):
+            for key, entry in list(table.items()):
+                if network.is_idle(entry[-1]):
+                    table.pop(key, None)
+    with sequence_windows_lock:
+        for key, entry in list(sequence_windows.items()):
+            if network.is_idle(entry[2]):
+                del sequence_windows[key]
+
+
+# Wakes the coroutine that has waited longest in Socket.async_receive on port, if any
+def _wake(port):
+    waiters = receive_waiters.get(port)
+    while waiters:
+        waiter = waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            return
+
+
+# Demultiplex a packet to the queue of the port it's for.
+# A network layer protocol handler, so called on its receive thread (or event loop).
+def _receive(message, src_loc, src_nid, dst_loc, dst_nid, interface):
+    sre_port_bytes, dst_port_bytes, epoch, sequence_number = HEADER.unpack_from(message)
+    src_port = util.bytes_to_int(sre_port_bytes)
+    dst_port = util.bytes_to_int(dst_port_bytes)
+    data = message[HEADER.size:]
+    # drop if not valid port (if there"s no socket bound to this port)
+    in_queue = in_queues.get(dst_port)
+    if in_queue == None:
+        return
+    # drop duplicates
+    key = (src_nid, src_port, dst_port)
+    tick = network.loc_to_interface.tick
+    entry = sequence_windows.get(key)
+    if entry == None or entry[0] != epoch:
+        # A new flow, or its sender restarted
+        with sequence_windows_lock:
+            entry = sequence_windows.get(key)
+            if entry == None or entry[0] != epoch:
+                entry = [epoch, tables.SequenceWindow(sequence_window), tick]
+                sequence_windows[key] = entry
+    entry[2] = tick
+    window = entry[1]
+    if not window.check(sequence_number):
+        return
+    # For handoff policies
+    network.record_received(interface, src_loc, window.take_lost())
+    if in_queue.put((
+        data,
+        (":".join([src_loc, src_nid]), src_port),
+        (":".join([dst_loc, dst_nid]), dst_port),
+        interface
+    )):
+        util.log_queue_drop(log_file, "Port %d queue" % dst_port, in_queue)
+
+    if dst_port in receive_cvs:
+        with receive_cvs[dst_port]:
+            receive_cvs[dst_port].notify()
+
+    _wake(dst_port)
+
+    if log_file != None:
+        util.write_log(log_file, "%-30s -> %-30s %s" % (
+            "[%s:%s%%%s]:%d" % (src_loc, src_nid, interface, src_port),
+            "[%s:%s]:%d" % (dst_loc, dst_nid, dst_port),
+            util.format_data(data, 32)
+        ))
 
 
 def startup():
     global log_file
     log_file = util.get_log_file("transport")
 
+    # Capacity and drop policy of sockets' queues, see util.PacketQueue
+    global queue_capacity, queue_policy
+    queue_capacity, queue_policy = util.get_queue_config("transport")
+    if queue_policy == "block" and network.runtime == "asyncio":
+        raise NetworkException("Queue policy 'block' would block the asyncio runtime's event loop")
+
+    # Number of sequence numbers below the highest received that are remembered,
+    # so reordered packets within it are accepted and duplicates dropped
+    global sequence_window
+    config_section = util.config["transport"]
+    if "sequence_window" in config_section:
+        sequence_window = config_section.getint("sequence_window")
+    else:
+        sequence_window = 64
+
     # cv = conditional value
     global receive_cvs
     receive_cvs = {}
-    ReceiveThread().start()
+    # Demultiplex as packets are received by the network layer
+    network.register_handler(PROTOCOL_NEXT_HEADER, _receive)
+    network.register_expiry(_expire)
 
 
 startup()
@@ -0,0 +1,66 @@
+import random
+import threading
+import time
+
+# Trickle algorithm timer (RFC 6206), deciding when to transmit.
+#
+# Time is divided into intervals, starting at imin seconds long and doubling
+# each interval up to imax while the transmissions heard are consistent.
+# In each interval a transmission is made at a random time in its second half,
+# unless at least k consistent transmissions have been heard in the interval.
+# On inconsistency the interval is reset to imin, so changes propagate quickly,
+# while in steady state transmissions back off to about k every imax.
+#
+# Polled rather than running its own timer, so it can be driven by a thread or a coroutine.
+# poll returns whether to transmit, and how long to wait before polling again.
+# reset may be called from any thread, and calls wake so the driver can poll early.
+class Trickle:
+    def __init__(self, imin, imax, k=1):
+        self.imin = imin
+        self.imax = imax
+        self.k = k
+        # Called on reset, set by the driver
+        self.wake = None
+        self.lock = threading.Lock()
+        self._start_interval(imin, time.monotonic())
+
+    def _start_interval(self, interval, now):
+        self.interval = interval
+        self.interval_start = now
+        # Time to transmit at, if not suppressed
+        self.t = now + random.uniform(interval / 2, interval)
+        # If it's past t in this interval
+        self.fired = False
+        # Consistent transmissions heard this interval
+        self.counter = 0
+
+    # A consistent transmission was heard
+    def hear_consistent(self):
+        with self.lock:
+            self.counter += 1
+
+    # An inconsistency was detected
+    def reset(self):
+        with self.lock:
+            # Already transmitting as often as possible
+            if self.interval == self.imin:
+                return
+            self._start_interval(self.imin, time.monotonic())
+        if self.wake != None:
+            self.wake()
+
+    # Returns (transmit, wait), where transmit is True if a transmission
+    # should be made now, and wait is the time until poll should next be called
+    def poll(self):
+        now = time.monotonic()
+        with self.lock:
+            transmit = False
+            if not self.fired and now >= self.t:
+                self.fired = True
+                transmit = self.counter < self.k
+            interval_end = self.interval_start + self.interval
+            if now >= interval_end:
+                self._start_interval(min(2 * self.interval, self.imax), now)
+                interval_end = now + self.interval
+            next_poll = interval_end if self.fired else self.t
+            return transmit, max(0, next_poll - now)
@@ -1,6 +1,8 @@
 import sys
 import os
 import socket
+import threading
+import collections
 import configparser
 from pathlib import Path
 from datetime import datetime
@@ -11,6 +13,12 @@ CONFIG_LINK_SECTION      = "link"
 CONFIG_NETWORK_SECTION   = "network"
 CONFIG_TRANSPORT_SECTION = "transport"
 
+# Minimum size of memory allocated at once by ReceiveBuffer
+RECEIVE_SLAB_SIZE = 65536
+
+# Default capacity of PacketQueues, in packets
+DEFAULT_QUEUE_CAPACITY = 1000
+
 
 class NetworkException(Exception):
     def __init__(self, message):
@@ -42,6 +50,139 @@ def bytes_to_hex(binary):
     ])
 
 
+# Bytes like object, or list of them, as a string truncated to max_length for logs
+def format_data(data, max_length):
+    if type(data) is list:
+        data = b"".join(data)
+    if len(data) > max_length:
+        return str(bytes(data[:max_length - 3])) + "..."
+    return str(bytes(data))
+
+
+# Memory to receive packets into, so they can be passed up the stack as
+# memoryviews without being copied. Packets are received into the unused end
+# of a slab of memory shared by many packets, which is freed once none of them
+# are referenced. Each thread has its own slab.
+class ReceiveBuffer(threading.local):
+    def __init__(self, packet_size):
+        self.packet_size = packet_size
+        self.slab_size = max(RECEIVE_SLAB_SIZE, 2 * packet_size)
+        self.free = memoryview(bytearray(0))
+        self.last = None
+
+    # Memory with space for at least one packet
+    def get(self):
+        if len(self.free) < self.packet_size:
+            self.free = memoryview(bytearray(self.slab_size))
+        return self.free
+
+    # Take the first nbytes of the memory returned by get for a received packet
+    def take(self, nbytes):
+        self.before_last = self.free
+        packet = self.free[:nbytes]
+        self.free = self.free[nbytes:]
+        self.last = packet
+        return packet
+
+    # Reuse the memory of a packet no longer referenced for the next packet.
+    # Only possible for the last packet taken by this thread.
+    def release(self, packet):
+        if packet is self.last:
+            self.free = self.before_last
+            self.last = None
+
+
+# Queue of received packets holding at most capacity packets, or unbounded if None.
+# Once full, policy determines which packet is shed:
+#  "drop_tail" drops the packet being added,
+#  "drop_head" drops the oldest queued packet to make room for it, or
+#  "block" blocks the thread adding the packet until there is room.
+# Counts the packets dropped, and the most queued at once (high water mark).
+class PacketQueue:
+    POLICIES = ("drop_tail", "drop_head", "block")
+
+    def __init__(self, capacity=None, policy="drop_tail"):
+        if policy not in PacketQueue.POLICIES:
+            raise ValueError("Unknown queue policy '%s'" % policy)
+        self.capacity = capacity
+        self.policy = policy
+        if policy == "drop_head":
+            # Appending to a full deque with a maxlen drops from the other end
+            self.queue = collections.deque(maxlen=capacity)
+        else:
+            self.queue = collections.deque()
+        self.dropped = 0
+        self.high_water = 0
+        # For the block policy, notified when a packet is removed while a thread is blocked
+        self.not_full = threading.Condition()
+        self.blocked = 0
+
+    # Returns True if a packet was dropped
+    def put(self, item):
+        queue = self.queue
+        length = len(queue)
+        if self.capacity != None and length >= self.capacity:
+            if self.policy == "drop_tail":
+                self.dropped += 1
+                return True
+            elif self.policy == "drop_head":
+                queue.append(item)
+                self.dropped += 1
+                return True
+            with self.not_full:
+                # Counted before checking the length again,
+                # so popleft either sees a blocked thread or made room before the check
+                self.blocked += 1
+                while len(queue) >= self.capacity:
+                    self.not_full.wait()
+                self.blocked -= 1
+            length = len(queue)
+        queue.append(item)
+        if length >= self.high_water:
+            self.high_water = length + 1
+        return False
+
+    # Raises IndexError if empty
+    def popleft(self):
+        item = self.queue.popleft()
+        if self.blocked > 0:
+            with self.not_full:
+                self.not_full.notify()
+        return item
+
+    def __len__(self):
+        return len(self.queue)
+
+
+# Reads queue_capacity and queue_policy from a config section, for PacketQueue.
+# A capacity of 0 means unbounded.
+def get_queue_config(section_name):
+    config_section = config[section_name]
+    if "queue_capacity" in config_section:
+        capacity = config_section.getint("queue_capacity")
+    else:
+        capacity = DEFAULT_QUEUE_CAPACITY
+    if capacity == 0:
+        capacity = None
+    if "queue_policy" in config_section:
+        policy = config_section["queue_policy"]
+    else:
+        policy = "drop_tail"
+    if policy not in PacketQueue.POLICIES:
+        raise NetworkException("Unknown queue policy '%s'" % policy)
+    return capacity, policy
+
+
+# Logs a queue's counters when the number of packets it dropped reaches a power of two,
+# so it's visible where packets are being shed without logging every drop
+def log_queue_drop(log_file, name, queue):
+    dropped = queue.dropped
+    if log_file != None and dropped & (dropped - 1) == 0:
+        write_log(log_file, "%s dropped %d packets (capacity %s, %s, high water %d)" % (
+            name, dropped, queue.capacity, queue.policy, queue.high_water
+        ))
+
+
 def get_log_file_path(log_type):
     path = os.path.join(
         os.path.dirname(__file__),